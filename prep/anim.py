@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 from bisect import bisect_left
+
+import numpy as np
+
 import transform as t
-import glfw
 
 from model import Node
 
@@ -30,65 +32,220 @@ class KeyFrames:
         return val
 
 
+class Tracks:
+    """ Keyframe tracks of same size values compiled to contiguous arrays:
+        the sorted key times of all the tracks one after the other, their
+        (K, D) float32 values, and the offset of each track in them. Many
+        tracks are evaluated at many times by one vectorized call, linearly
+        or with quaternion slerp, or from a lookup table once baked """
+
+    def __init__(self, tracks, slerp=False):
+        times, values, offsets = [], [], [0]
+        for time_value_pairs in tracks:
+            if isinstance(time_value_pairs, dict):  # convert to list of pairs
+                time_value_pairs = time_value_pairs.items()
+            keyframes = sorted(time_value_pairs, key=lambda pair: pair[0])
+            times.extend(key[0] for key in keyframes)
+            values.extend(np.asarray(key[1], 'f').reshape(-1) for key in keyframes)
+            offsets.append(len(times))
+        self.times = np.array(times, np.float64)
+        self.values = np.array(values, 'f')
+        self.offsets = np.array(offsets)
+        self.slerp = slerp
+        self.lut = None  # (tracks, samples, D) values sampled at self.rate
+
+        # times shifted by track number * span sort the keys of all tracks
+        # in one array, any track searched at once with np.searchsorted
+        self.start, self.end = self.times.min(), self.times.max()
+        self.span = self.end - self.start + 1
+        self.keyed = self.times - self.start + np.repeat(np.arange(len(self)), np.diff(self.offsets)) * self.span
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _targets(self, times, tracks):
+        """ (N,) float64 times and int track numbers, all tracks if None """
+        tracks = np.arange(len(self)) if tracks is None else np.asarray(tracks)
+        times, tracks = np.broadcast_arrays(np.asarray(times, np.float64), tracks)
+        return times.reshape(-1), tracks.reshape(-1)
+
+    def evaluate(self, times, tracks=None):
+        """ (N, D) values of the 'tracks' numbers at 'times', broadcast
+            together, from the keys or the lookup table if baked """
+        times, tracks = self._targets(times, tracks)
+        if self.lut is not None:
+            samples = len(self.lut[0])
+            index = np.clip((times - self.start) * self.rate, 0, samples - 1)
+            lower = np.minimum(index.astype(int), max(samples - 2, 0))
+            upper = np.minimum(lower + 1, samples - 1)
+            return self._interpolate(self.lut[tracks, lower], self.lut[tracks, upper], index - lower, True)
+
+        first, last = self.offsets[tracks], self.offsets[tracks + 1] - 1
+        times = np.clip(times, self.times[first], self.times[last])
+        upper = np.searchsorted(self.keyed, times - self.start + tracks * self.span, side='right')
+        upper = np.minimum(np.maximum(upper, first + 1), last)  # in the track, past a single key
+        lower = np.maximum(upper - 1, first)
+        duration = self.times[upper] - self.times[lower]
+        fractions = (times - self.times[lower]) / np.where(duration > 0, duration, 1)
+        return self._interpolate(self.values[lower], self.values[upper], fractions)
+
+    def _interpolate(self, values_a, values_b, fractions, close=False):
+        """ batched interpolation of (N, D) values by (N,) fractions. Close
+            quaternions, as sampled in the table, are linearly interpolated """
+        fractions = np.asarray(fractions, 'f')
+        if not self.slerp:
+            return t.lerp(values_a, values_b, fractions[:, np.newaxis])
+        if not close:
+            return t.quaternion_slerp_many(values_a, values_b, fractions)
+        signs = np.where(np.einsum('ni,ni->n', values_a, values_b) < 0, -1, 1).astype('f')
+        return t.normalized_many(t.lerp(values_a, values_b * signs[:, np.newaxis], fractions[:, np.newaxis]))
+
+    def bake(self, rate):
+        """ sample all tracks 'rate' times a second over all the keys, later
+            evaluations then cost the same whatever the number of keys """
+        self.lut, self.rate = None, rate
+        samples = int(np.ceil((self.end - self.start) * rate)) + 1
+        times = self.start + np.arange(samples) / rate
+        lut = self.evaluate(times[np.newaxis, :], np.arange(len(self))[:, np.newaxis])
+        self.lut = lut.reshape(len(self), samples, -1)
+        return self
+
+
+class TransformTracks:
+    """ Translation, rotation and scale keys of several objects, evaluated
+        together into their (N, 4, 4) TRS matrices """
+
+    def __init__(self, keys):
+        """ keys: (translate_keys, rotate_keys, scale_keys) of each object,
+            scales being uniform or per axis """
+        keys = list(keys)
+        self.translate = Tracks(key[0] for key in keys)
+        self.rotate = Tracks((key[1] for key in keys), slerp=True)
+        self.scale = Tracks(_pairs(key[2], lambda value: np.broadcast_to(np.asarray(value, 'f'), 3))
+                            for key in keys)
+        self.cache = (None, None)  # (time, matrices of all objects)
+
+    def __len__(self):
+        return len(self.translate)
+
+    def evaluate(self, times, tracks=None, out=None):
+        """ (N, 4, 4) transforms of objects 'tracks' at 'times', broadcast
+            together, all objects if None """
+        return t.compose_trs_many(self.translate.evaluate(times, tracks), self.rotate.evaluate(times, tracks),
+                                  self.scale.evaluate(times, tracks), out)
+
+    def bake(self, rate):
+        """ constant time evaluation from tables sampled at 'rate' per second """
+        for tracks in (self.translate, self.rotate, self.scale):
+            tracks.bake(rate)
+        self.cache = (None, None)
+        return self
+
+    def value(self, time, track=0):
+        """ transform of object 'track' at 'time', all the objects being
+            evaluated at once the first time one asks for this time """
+        cached_time, matrices = self.cache
+        if cached_time != time:
+            matrices = self.evaluate(time)
+            self.cache = (time, matrices)
+        return matrices[track]
+
+
+def _pairs(time_value_pairs, function):
+    """ (time, function(value)) keyframe pairs """
+    if isinstance(time_value_pairs, dict):
+        time_value_pairs = time_value_pairs.items()
+    return [(time, function(value)) for time, value in time_value_pairs]
+
+
 class TransformKeyFrames:
     """ KeyFrames-like object dedicated to 3D transforms """
 
     def __init__(self, translate_keys, rotate_keys, scale_keys):
         """ stores 3 keyframe sets for translation, rotation, scale """
-        self.translate_keys = KeyFrames(translate_keys)
-        self.rotate_keys = KeyFrames(rotate_keys, t.quaternion_slerp)
-        self.scale_keys = KeyFrames(scale_keys)
+        self.tracks = TransformTracks([(translate_keys, rotate_keys, scale_keys)])
 
     def value(self, time):
         """ Compute each component's interpolation and compose TRS matrix """
-        trans_mat = t.translate(self.translate_keys.value(time))
-        rot_mat = t.quaternion_matrix(self.rotate_keys.value(time))
-        scale_mat = t.scale(self.scale_keys.value(time))
-        keyframe_transform = trans_mat @ (rot_mat @ scale_mat)
-        return keyframe_transform
+        return self.tracks.value(time)
 
 
-class ObjectKeyFrameControlNode(Node):
-    """ Place node with transform keys above a controlled subtree """
-    def __init__(self, translate_keys, rotate_keys, scale_keys):
+class AnimatedNode(Node):
+    """ Node whose transform is evaluated at each fixed simulation step and
+        interpolated between the last two steps when drawn, translation,
+        rotation and scale apart so that it stays a rigid transform """
+    def __init__(self):
         super().__init__()
-        self.keyframes = TransformKeyFrames(translate_keys, rotate_keys, scale_keys)
-
-    def draw(self, projection, view, model):
-        """ When redraw requested, interpolate our node transform from keys """
-        tim = glfw.get_time()
-        self.transform = self.keyframes.value(tim)  # transform belongs to parent class i,e, Node
-        super().draw(projection, view, model)
+        self.states = None  # (previous, latest) simulated transforms
+        self.drawn = None   # (states, alpha) of the current transform
+        self.trs = None     # (states, their translations, quaternions, scales)
+
+    def evaluate(self, time):
+        """ node transform at simulated 'time' """
+        return self.transform
+
+    def simulate(self, time, delta_time):
+        latest = self.evaluate(time)
+        # a null step restarts the timeline, nothing to interpolate from
+        previous = self.states[1] if self.states is not None and delta_time else latest
+        self.states = (previous, latest)  # swapped at once for the renderer
+
+    def animate(self, **param):
+        """ When redraw requested, interpolate our node transform from states """
+        if self.states is None:
+            self.simulate(param.get('time', 0.0), 0.0)
+        states, alpha = self.states, param.get('alpha', 1.0)
+        if self.drawn is None or self.drawn[0] is not states or self.drawn[1] != alpha:
+            # new transform marks the subtree dirty, otherwise the cache holds
+            self.transform = self.interpolate(states, alpha)  # transform belongs to parent class i,e, Node
+            self.drawn = (states, alpha)
+
+    def interpolate(self, states, alpha):
+        """ transform 'alpha' of the way between the (previous, latest) ones """
+        if states[0] is states[1] or alpha >= 1:
+            return states[1]
+        if alpha <= 0:
+            return states[0]
+        if self.trs is None or self.trs[0] is not states:
+            self.trs = (states,) + t.decompose_trs_many(np.stack(states))
+        _, translations, rotations, scales = self.trs
+        return t.compose_trs_many(t.lerp(translations[0], translations[1], alpha),
+                                  t.quaternion_slerp_many(rotations[0], rotations[1], alpha),
+                                  t.lerp(scales[0], scales[1], alpha)[np.newaxis])[0]
+
+
+class ObjectKeyFrameControlNode(AnimatedNode):
+    """ Place node with transform keys above a controlled subtree. Nodes
+        animated by the same TransformTracks, each its object 'track' in
+        it, are evaluated together once per simulation step """
+    def __init__(self, translate_keys=None, rotate_keys=None, scale_keys=None, tracks=None, track=0):
+        super().__init__()
+        if tracks is None:
+            tracks = TransformTracks([(translate_keys, rotate_keys, scale_keys)])
+        self.tracks, self.track = tracks, track
 
-    def key_handler(self, key):
-        if key == glfw.KEY_SPACE:
-            glfw.set_time(0)
-            super().key_handler(key)
+    def evaluate(self, time):
+        """ interpolate our node transform from keys """
+        return self.tracks.value(time, self.track)
 
 
-class ProceduralAnim(Node):
-    """ Place node with transform keys above a controlled subtree """
+class ProceduralAnim(AnimatedNode):
+    """ Place node with procedurally generated transform above a controlled subtree """
     def __init__(self, anim_func):
         super().__init__()
         self.gen_keyframe = anim_func
 
-    def draw(self, projection, view, model):
-        """ When redraw requested, interpolate our node transform from keys """
-        self.transform = self.gen_keyframe()  # transform belongs to parent class i,e, Node
-        super().draw(projection, view, model)
+    def evaluate(self, time):
+        """ anim_func maps simulated time to the node transform """
+        return self.gen_keyframe(time)
 
 
-class CameraKeyFrameControlNode(Node):
+class CameraKeyFrameControlNode(AnimatedNode):
     """ Place node with transform keys above a controlled subtree """
     def __init__(self, translate_keys, rotate_keys, scale_keys):
         super().__init__()
         self.keyframes = TransformKeyFrames(translate_keys, rotate_keys, scale_keys)
 
-    def draw(self, projection, view, model):
-        """ When redraw requested, interpolate our node transform from keys """
-        self.transform = self.keyframes.value(glfw.get_time())  # transform belongs to parent class i,e, Node
-        super().draw(projection, view, model)
-
-    def key_handler(self, key):
-        glfw.set_time(0)
-        super().key_handler(key)
+    def evaluate(self, time):
+        """ interpolate our node transform from keys """
+        return self.keyframes.value(time)
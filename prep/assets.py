@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import os
+
+
+# ------------- process wide cache of shared GPU assets -----------------------
+class AssetRegistry:
+    """ Reference counted store of assets, each one built once and shared """
+
+    def __init__(self):
+        self.entries = {}    # key -> [asset, reference count, dependency keys,
+                             #         callbacks waiting for it or None once built]
+        self._building = []  # dependency lists of the assets being built
+
+    def acquire(self, key, factory):
+        """ Shared asset for 'key', built with factory() on first request.
+            Assets acquired while the factory runs become its dependencies
+            and are released along with it. """
+        if key not in self.entries:
+            self._building.append([])
+            try:
+                asset = factory()
+            finally:
+                deps = self._building.pop()
+            self.entries[key] = [asset, 0, deps, None]
+        entry = self.entries[key]
+        entry[1] += 1
+        if self._building:
+            self._building[-1].append(key)
+        return entry[0]
+
+    def acquire_async(self, key, start, callback):
+        """ Like acquire, for assets prepared in the background: on first
+            request start(finish, fail) launches the work, which later calls
+            finish(factory) on the thread owning the assets to build it, or
+            fail() if it could not. callback(asset) is called as soon as the
+            asset is built, callback(None) if it failed: the asset is then
+            forgotten, and tried again by the next request """
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [None, 1, [], [callback]]
+            start(lambda factory: self._finish(key, entry, factory), lambda: self._fail(key, entry))
+        else:
+            entry[1] += 1
+            if entry[3] is None:
+                callback(entry[0])
+            else:
+                entry[3].append(callback)
+        if self._building:
+            self._building[-1].append(key)
+
+    def _finish(self, key, entry, factory):
+        if self.entries.get(key) is not entry:
+            return  # released before being built, nothing to build
+        self._building.append([])
+        try:
+            entry[0] = factory()
+        finally:
+            entry[2] = self._building.pop()
+        callbacks, entry[3] = entry[3], None
+        for callback in callbacks:
+            callback(entry[0])
+
+    def _fail(self, key, entry):
+        if entry[3] is None:
+            return  # already built, or already failed
+        if self.entries.get(key) is entry:
+            del self.entries[key]
+        callbacks, entry[3] = entry[3], None
+        for callback in callbacks:
+            callback(None)
+
+    def release(self, key):
+        """ Drop one reference, the asset is forgotten with the last one """
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self.entries[key]
+            for dep in entry[2]:
+                self.release(dep)
+
+    def count(self, key):
+        """ Number of live references to 'key' """
+        return self.entries[key][1] if key in self.entries else 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def file_key(kind, file, *extra):
+    """ Registry key for an asset built from 'file' with given parameters """
+    return (kind, os.path.normcase(os.path.abspath(file))) + extra
+
+
+registry = AssetRegistry()
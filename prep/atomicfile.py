@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# cache files written whole or not at all, safe from concurrent writers
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def replace(path, mode='wb'):
+    """ file object to write the new content of 'path' to. It goes to a
+        unique temporary file next to path, so that threads or processes
+        writing the same path never share it, which replaces path once
+        complete, or is removed if the writing fails """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    out = tempfile.NamedTemporaryFile(mode, dir=directory, prefix=os.path.basename(path),
+                                      suffix='.tmp', delete=False)
+    try:
+        with out:
+            yield out
+        os.replace(out.name, path)
+    except BaseException:
+        os.remove(out.name)
+        raise
@@ -2,9 +2,23 @@ import numpy as np
 import transform as t
 import objects as o
 from model import Node
+from neighbors import SpatialGrid, csr_rows, segment_sum
 
 boid_cnt = 10
 
+# weights and distances of the flocking rules, in world units and seconds
+FISH_RULES = {'view_radius': 2.0,      # neighbours seen for cohesion/alignment
+              'separation_radius': 0.6,
+              'cohesion': 0.8,
+              'alignment': 1.5,
+              'separation': 4.0,
+              'bounds': 2.0,           # pull back inside the flock's box
+              'min_speed': 0.5,
+              'max_speed': 2.5}
+
+# above this many boids neighbours come from a spatial grid, not all pairs
+DENSE_LIMIT = 256
+
 
 def new_flock(count, lower_limits, upper_limits):
     width = upper_limits - lower_limits
@@ -14,10 +28,168 @@ def new_flock(count, lower_limits, upper_limits):
 positions = new_flock(boid_cnt, np.array([10, 90, 0]), np.array([20, 110, 0]))
 
 
-def get_boid(shader, fish, count, lower_limits, upper_limits, rot_axis=(0.0, 0.0, 0.0), rot_angle=0.0, scale=1.0):
+def steer(positions, velocities, rules, lower_limits, upper_limits, lo=0, hi=None, grid=None):
+    """ acceleration of boids lo:hi from the other boids of the flock, seen
+        through 'grid' (a SpatialGrid of positions). Without one, flocks of up
+        to DENSE_LIMIT boids test all pairs, larger ones build their grid """
+    pos, vel = positions[lo:hi], velocities[lo:hi]
+    view2, sep2 = rules['view_radius'] ** 2, rules['separation_radius'] ** 2
+    if grid is None and len(positions) > DENSE_LIMIT:
+        grid = SpatialGrid(rules['view_radius']).build(positions)  # (M, N, 3) offsets would not fit
+    if grid is None:
+        offsets = positions[np.newaxis, :, :] - pos[:, np.newaxis, :]  # (M, N, 3)
+        dist2 = np.einsum('ijk,ijk->ij', offsets, offsets)
+        near = ((dist2 < view2) & (dist2 > 0)).astype(np.float32)
+        close = ((dist2 < sep2) & (dist2 > 0)).astype(np.float32)
+        count = near.sum(axis=1)[:, np.newaxis]
+        near_pos, near_vel = near @ positions, near @ velocities
+        close_count, close_pos = close.sum(axis=1)[:, np.newaxis], close @ positions
+    else:
+        indptr, others = grid.query(pos, rules['view_radius'])
+        rows = csr_rows(indptr)
+        delta = positions[others] - pos[rows]
+        dist2 = np.einsum('ij,ij->i', delta, delta)
+        seen, near = dist2 > 0, (dist2 > 0) & (dist2 < sep2)
+        rows, others, close_rows, close_others = rows[seen], others[seen], rows[near], others[near]
+        count = np.bincount(rows, minlength=len(pos))[:, np.newaxis]
+        near_pos = segment_sum(rows, positions[others], len(pos))
+        near_vel = segment_sum(rows, velocities[others], len(pos))
+        close_count = np.bincount(close_rows, minlength=len(pos))[:, np.newaxis]
+        close_pos = segment_sum(close_rows, positions[close_others], len(pos))
+
+    seen = np.maximum(count, 1)
+    cohesion = (near_pos / seen - pos) * (count > 0)
+    alignment = (near_vel / seen - vel) * (count > 0)
+    separation = close_count * pos - close_pos
+    bounds = np.clip(pos, lower_limits, upper_limits) - pos
+
+    return (rules['cohesion'] * cohesion + rules['alignment'] * alignment
+            + rules['separation'] * separation + rules['bounds'] * bounds)
+
+
+def limit_speed(velocities, min_speed, max_speed):
+    """ clamp each velocity norm in [min_speed, max_speed], in place """
+    speed = np.linalg.norm(velocities, axis=1)[:, np.newaxis]
+    velocities *= np.clip(speed, min_speed, max_speed) / np.maximum(speed, 1e-6)
+    return velocities
+
+
+def advance(positions, velocities, rules, lower_limits, upper_limits, delta_time, lo=0, hi=None, grid=None):
+    """ positions and velocities of boids lo:hi after delta_time seconds """
+    accel = steer(positions, velocities, rules, lower_limits, upper_limits, lo, hi, grid)
+    new_velocities = velocities[lo:hi] + accel.astype(np.float32) * delta_time
+    limit_speed(new_velocities, rules['min_speed'], rules['max_speed'])
+    return positions[lo:hi] + new_velocities * delta_time, new_velocities
+
+
+def heading_matrices(positions, velocities, base=None, out=None):
+    """ (N, 4, 4) model matrices placing each boid at its position with its
+        local +z axis along its velocity, after the 'base' model transform.
+        Written to the float32 'out' array if given """
+    forward = t.normalized_many(velocities)
+    right = np.cross((0.0, 1.0, 0.0), forward)
+    norm = np.linalg.norm(right, axis=1)[:, np.newaxis]
+    right = np.where(norm > 1e-6, right / np.maximum(norm, 1e-6), (1.0, 0.0, 0.0))
+    up = np.cross(forward, right)
+
+    matrices = t.translate_many(positions, None if base is not None else out)
+    matrices[:, :3, 0], matrices[:, :3, 1], matrices[:, :3, 2] = right, up, forward
+    return matrices if base is None else np.matmul(matrices, base, out=out)
+
+
+class Flock:
+    """ Boids flock, positions and velocities stored as (N, 3) float32 arrays
+        and the whole flock advanced by array operations at each step """
+
+    def __init__(self, count, lower_limits, upper_limits, rules=FISH_RULES):
+        lower_limits, upper_limits = np.asarray(lower_limits, 'f'), np.asarray(upper_limits, 'f')
+        self.lower_limits = np.minimum(lower_limits, upper_limits)
+        self.upper_limits = np.maximum(lower_limits, upper_limits)
+        self.rules = dict(FISH_RULES, **rules)
+        self.positions = new_flock(count, self.lower_limits, self.upper_limits).astype(np.float32)
+        directions = np.random.randn(count, 3).astype(np.float32)
+        self.velocities = limit_speed(directions, self.rules['min_speed'], self.rules['max_speed'])
+        self.grid = SpatialGrid(self.rules['view_radius'])
+
+    def __len__(self):
+        return len(self.positions)
+
+    def step(self, delta_time):
+        """ advance the simulation by delta_time seconds """
+        grid = self.grid.build(self.positions) if len(self) > DENSE_LIMIT else None
+        self.positions, self.velocities = advance(self.positions, self.velocities, self.rules,
+                                                  self.lower_limits, self.upper_limits, delta_time, grid=grid)
+
+    def matrices(self, base=None):
+        """ model matrix of every boid, heading along its velocity """
+        return heading_matrices(self.positions, self.velocities, base)
+
+
+class FlockNode(Node):
+    """ Steps a flock at each simulation step and feeds the interpolated boid
+        transforms to its fish, either one instanced fish or a node per boid """
+
+    def __init__(self, flock, *boids, base=None):
+        super().__init__()
+        self.flock, self.base = flock, base
+        self.instanced = len(boids) == 1 and hasattr(boids[0], 'set_instances')
+        self.states = None  # (previous, latest) copies of (positions, velocities)
+        self.add(*boids)
+        self.update_boids(self.flock.positions, self.flock.velocities)
+
+    def update_boids(self, positions, velocities):
+        """ push boid transforms for given flock state to the children """
+        matrices = heading_matrices(positions, velocities, self.base)
+        if self.instanced:
+            self.children[0].set_instances(matrices)
+        else:
+            for child, matrix in zip(self.children, matrices):
+                child.transform = matrix
+
+    def simulate(self, time, delta_time):
+        if delta_time:
+            self.flock.step(delta_time)
+        latest = (self.flock.positions.copy(), self.flock.velocities.copy())
+        self.states = (self.states[1] if self.states is not None and delta_time else latest, latest)
+
+    def animate(self, **param):
+        """ boids interpolated between the last two simulation steps """
+        if self.states is not None:
+            (prev_pos, prev_vel), (pos, vel) = self.states
+            alpha = param.get('alpha', 1.0)
+            self.update_boids(t.lerp(prev_pos, pos, alpha), t.lerp(prev_vel, vel, alpha))
+
+
+def get_flock(count, lower_limits, upper_limits, rules, scheduler=None):
+    """ new Flock, stepped by the worker processes of scheduler if given """
+    flock = Flock(count, lower_limits, upper_limits, rules)
+    return flock if scheduler is None else scheduler.share(flock)
+
+
+def get_boid(shader, fish, count, lower_limits, upper_limits, rot_axis=(0.0, 0.0, 0.0), rot_angle=0.0, scale=1.0,
+             rules=None, scheduler=None):
+    """ flock of count fish, scattered in the limits box or swimming as boids
+        when flocking rules are given (the model should then face local +z) """
+    if rules is not None:
+        base = (t.rotate(rot_axis, rot_angle) @ t.scale(scale)).astype(np.float32)
+        boids = [Node(children=[o.Fish(shader, fish)]) for _ in range(count)]
+        return [FlockNode(get_flock(count, lower_limits, upper_limits, rules, scheduler), *boids, base=base)]
     boid_shape = []
     positions = new_flock(count, lower_limits, upper_limits)
     for i in range(count):
         boid_shape.append(Node(transform=t.translate(positions[i][0], positions[i][1], positions[i][2]) @ t.rotate(rot_axis, rot_angle) @ t.scale(scale)))
         boid_shape[i].add(o.Fish(shader, fish))
     return boid_shape
+
+
+def get_instanced_boid(shader, fish, count, lower_limits, upper_limits, rot_axis=(0.0, 0.0, 0.0), rot_angle=0.0,
+                       scale=1.0, rules=None, scheduler=None):
+    """ same flock as get_boid, drawn by a single instanced node """
+    base = (t.rotate(rot_axis, rot_angle) @ t.scale(scale)).astype(np.float32)
+    if rules is not None:
+        flock = get_flock(count, lower_limits, upper_limits, rules, scheduler)
+        return [FlockNode(flock, o.InstancedFish(shader, fish), base=base)]
+    positions = new_flock(count, lower_limits, upper_limits)
+    matrices = np.repeat(base[np.newaxis], count, axis=0)
+    matrices[:, :3, 3] = positions
+    return [o.InstancedFish(shader, fish, matrices)]
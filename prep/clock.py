@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# fixed rate simulation loop, decoupled from the render loop
+
+import threading
+import time as systime
+
+MAX_CATCH_UP = 5  # simulation steps run at most per tick before dropping time
+
+
+class SimulationClock:
+    """ Advances the scene graph's simulated state at a fixed rate in its own
+        thread. The renderer samples it once per frame and interpolates
+        between the last two simulated states """
+
+    def __init__(self, root, rate=60.0):
+        self.root = root              # anything with an update(time, delta_time)
+        self.step = 1.0 / rate
+        self.time = 0.0               # simulated time of the latest state
+        self.lock = threading.Lock()
+        self._origin = systime.perf_counter()
+        self._thread = None
+        self._running = False
+
+    def now(self):
+        """ wall clock time since the start of the timeline """
+        return systime.perf_counter() - self._origin
+
+    def tick(self):
+        """ run the simulation steps that are due, returns their count """
+        steps = 0
+        with self.lock:
+            while self.time + self.step <= self.now():
+                if steps == MAX_CATCH_UP:  # too slow: skip time, not frames
+                    self._origin = systime.perf_counter() - self.time
+                    break
+                self.time += self.step
+                self.root.update(self.time, self.step)
+                steps += 1
+        return steps
+
+    def _run(self):
+        while self._running:
+            self.tick()
+            systime.sleep(max(0.0, self.time + self.step - self.now()))
+
+    def start(self):
+        """ simulate in a background thread, from time 0 """
+        self.reset()
+        self.tick()  # the first state must exist before the first frame
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='simulation', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        """ restart the timeline at 0 """
+        with self.lock:
+            self._origin = systime.perf_counter()
+            self.time = 0.0
+            self.root.update(self.time, 0.0)
+
+    def frame(self):
+        """ per frame sample: (render time, interpolation factor between the
+            previous and latest simulated states), rendering one step late """
+        alpha = min(max((self.now() - self.time) / self.step, 0.0), 1.0)
+        return self.time - self.step + alpha * self.step, alpha
@@ -0,0 +1,5 @@
+#version 330 core
+
+// depth only: no color output, the depth buffer is written by the fixed stages
+void main() {
+}
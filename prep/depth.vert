@@ -0,0 +1,17 @@
+#version 330 core
+
+layout(location = 0) in vec3 position;
+
+struct MVP{
+    mat4 model;
+    mat4 view;
+    mat4 projection;
+};
+uniform MVP mvp;
+
+// same depth as the lit pass, which redraws with GL_EQUAL
+invariant gl_Position;
+
+void main() {
+    gl_Position = mvp.projection * mvp.view * mvp.model * vec4(position, 1);
+}
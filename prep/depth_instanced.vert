@@ -0,0 +1,19 @@
+#version 330 core
+
+layout(location = 0) in vec3 position;
+layout(location = 3) in mat4 instance_model;  // one per fish, locations 3 to 6
+
+struct MVP{
+    mat4 model;
+    mat4 view;
+    mat4 projection;
+};
+uniform MVP mvp;
+
+// same depth as the lit pass, which redraws with GL_EQUAL
+invariant gl_Position;
+
+void main() {
+    mat4 model = mvp.model * instance_model;
+    gl_Position = mvp.projection * mvp.view * model * vec4(position, 1);
+}
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# index of the asset files, replacing per lookup directory walks
+
+import json
+import os
+import threading
+
+import atomicfile
+
+CACHE_FILE = os.path.join('.cache', 'index.json')
+SKIPPED = ('.', '__pycache__')  # prefixes of directories never indexed
+
+
+def _norm(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+class AssetIndex:
+    """ Files of an asset directory tree, walked once and persisted with the
+        directory mtimes so that a later start only needs to stat them.
+        Lookups by file name, stem or directory name are dictionary accesses """
+
+    def __init__(self, root='.', cache_file=CACHE_FILE):
+        self.root, self.cache_file = root, cache_file
+        self.dirs = self._load() or self._walk()  # dir -> (mtime, dirs, files)
+        self.by_name, self.by_stem, self.by_dir_name = {}, {}, {}
+        for directory, (_, _, files) in self.dirs.items():
+            self.by_dir_name.setdefault(os.path.basename(directory).lower(), []).append(directory)
+            for file in files:
+                path = os.path.join(directory, file)
+                self.by_name.setdefault(file.lower(), []).append(path)
+                self.by_stem.setdefault(os.path.splitext(file)[0].lower(), []).append(path)
+
+    def _walk(self):
+        dirs = {}
+        try:  # before the walk, creating it changes the root's mtime
+            os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        except OSError:
+            pass
+        for directory, subdirs, files in os.walk(self.root, followlinks=True):
+            subdirs[:] = sorted(d for d in subdirs if not d.startswith(SKIPPED))
+            dirs[_norm(directory)] = (os.stat(directory).st_mtime_ns, subdirs, sorted(files))
+        try:
+            with atomicfile.replace(self.cache_file, 'w') as cache:
+                json.dump({'root': _norm(self.root), 'dirs': dirs}, cache)
+        except OSError as exception:
+            print('WARNING: unable to write asset index', self.cache_file, exception)
+        return dirs
+
+    def _load(self):
+        """ persisted index, None if missing or if any directory changed """
+        try:
+            with open(self.cache_file) as cache:
+                content = json.load(cache)
+            if content['root'] != _norm(self.root):
+                return None
+            for directory, (mtime, _, _) in content['dirs'].items():
+                if os.stat(directory).st_mtime_ns != mtime:
+                    return None
+            return {directory: tuple(entry) for directory, entry in content['dirs'].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _under(self, paths, directory):
+        if directory is None:
+            return list(paths)
+        prefix = _norm(directory)
+        return [p for p in paths if prefix == os.curdir or p == prefix or p.startswith(prefix + os.sep)]
+
+    def files(self, directory):
+        """ all files of a directory subtree """
+        found, pending = [], [_norm(directory)]
+        while pending:
+            current = pending.pop()
+            if current in self.dirs:
+                _, subdirs, files = self.dirs[current]
+                found += [os.path.join(current, f) for f in files]
+                pending += [os.path.join(current, d) for d in reversed(subdirs)]
+        return found
+
+    def find(self, name, directory=None):
+        """ files of 'directory' subtree matching 'name' by file name, then by
+            stem, then as prefix of each other like a texture reference """
+        name = os.path.basename(name).lower()
+        for table, key in ((self.by_name, name), (self.by_stem, os.path.splitext(name)[0])):
+            found = self._under(table.get(key, ()), directory)
+            if found:
+                return found
+        return [p for p in self.files(directory or self.root)
+                if name.startswith(os.path.basename(p).lower()) or os.path.basename(p).lower().startswith(name)]
+
+    def find_dir(self, name, directory=None):
+        """ directories of 'directory' subtree whose name is 'name' """
+        return self._under(self.by_dir_name.get(name.lower(), ()), directory)
+
+
+_indices, _lock = {}, threading.Lock()
+
+
+def index(root='.'):
+    """ process wide index of root, built or loaded on first use """
+    with _lock:
+        if _norm(root) not in _indices:
+            _indices[_norm(root)] = AssetIndex(root)
+        return _indices[_norm(root)]
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# cache of the GL bindings and capabilities, dropping redundant calls
+
+import OpenGL.GL as GL
+
+
+class GLState:
+    """ Last value set for each piece of tracked GL state. Setting a value
+        already current costs a dictionary lookup instead of a GL call.
+        Code changing tracked state must go through it, or forget() it """
+    OBJECTS = ('program', 'vertex_array', 'texture', 'framebuffer', 'uniform_buffer')
+
+    def __init__(self):
+        self.current = {'texture_unit': 0}  # GL defaults that calls rely on
+        self.issued, self.skipped = 0, 0
+        self.last_frame = (0, 0)  # (issued, skipped) calls of the last frame
+
+    def _set(self, key, value):
+        """ True if the call setting key to value must be issued """
+        if self.current.get(key) == value:
+            self.skipped += 1
+            return False
+        self.current[key] = value
+        self.issued += 1
+        return True
+
+    def use_program(self, glid):
+        if self._set('program', glid):
+            GL.glUseProgram(glid)
+
+    def bind_vertex_array(self, glid):
+        if self._set('vertex_array', glid):
+            GL.glBindVertexArray(glid)
+
+    def active_texture(self, unit):
+        if self._set('texture_unit', unit):
+            GL.glActiveTexture(GL.GL_TEXTURE0 + unit)
+
+    def bind_texture(self, target, glid, unit=None):
+        """ bind on texture unit 'unit', or on the active unit if None """
+        unit = self.current.get('texture_unit', 0) if unit is None else unit
+        self.active_texture(unit)
+        if self._set(('texture', unit, target), glid):
+            GL.glBindTexture(target, glid)
+
+    def bind_framebuffer(self, glid):
+        if self._set('framebuffer', glid):
+            GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, glid)
+
+    def bind_uniform_buffer(self, binding, glid):
+        if self._set(('uniform_buffer', binding), glid):
+            GL.glBindBufferBase(GL.GL_UNIFORM_BUFFER, binding, glid)
+
+    def enable(self, capability, enabled=True):
+        if self._set(('capability', capability), enabled):
+            (GL.glEnable if enabled else GL.glDisable)(capability)
+
+    def disable(self, capability):
+        self.enable(capability, False)
+
+    def depth_func(self, func):
+        if self._set('depth_func', func):
+            GL.glDepthFunc(func)
+
+    def depth_mask(self, flag):
+        if self._set('depth_mask', bool(flag)):
+            GL.glDepthMask(flag)
+
+    def color_mask(self, flag):
+        if self._set('color_mask', bool(flag)):
+            GL.glColorMask(flag, flag, flag, flag)
+
+    def forget(self, *glids):
+        """ drop cached bindings of deleted objects, as GL resets them to 0 """
+        for key, value in list(self.current.items()):
+            kind = key[0] if isinstance(key, tuple) else key
+            if kind in self.OBJECTS and value in glids:
+                del self.current[key]
+
+    def reset(self):
+        """ forget everything, after GL state changed behind the cache """
+        self.current.clear()
+
+    def end_frame(self):
+        """ close the per frame call counts, returns (issued, skipped) """
+        self.last_frame, self.issued, self.skipped = (self.issued, self.skipped), 0, 0
+        return self.last_frame
+
+
+gl = GLState()
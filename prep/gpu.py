@@ -1,9 +1,47 @@
 #!/usr/bin/env python3
 
 import os
+import ctypes
+import weakref
+from functools import partial
+
 import OpenGL.GL as GL  # standard Python OpenGL wrapper
 import numpy as np  # all matrix manipulations & OpenGL args
 
+from glstate import gl
+from resources import resources
+
+
+# ------------ deletion of the GL objects, run by the resource manager --------
+def delete_program(glid):
+    gl.forget(glid)
+    GL.glDeleteProgram(glid)
+
+
+def delete_buffers(buffers):
+    gl.forget(*buffers)
+    GL.glDeleteBuffers(len(buffers), buffers)
+
+
+def delete_vertex_array(glid, buffers=()):
+    gl.forget(glid)
+    GL.glDeleteVertexArrays(1, [glid])
+    if buffers:
+        delete_buffers(buffers)
+
+
+def delete_texture_buffer(glid, buffer):
+    gl.forget(glid, buffer)
+    GL.glDeleteTextures(glid)
+    GL.glDeleteBuffers(1, [buffer])
+
+
+def delete_instanced(names):
+    """ instance buffer and vertex array, if any, of an InstancedVertexArray """
+    if names['vertex_array'] is not None:
+        delete_vertex_array(names['vertex_array'])
+    delete_buffers([names['buffer']])
+
 
 # ------------ low level OpenGL object wrappers ----------------------------
 class Shader:
@@ -29,6 +67,7 @@ class Shader:
     def __init__(self, vertex_source, fragment_source):
         """ Shader can be initialized with raw strings or source file names """
         self.glid = None
+        self.uniforms = {}  # uniform locations by name, see locations()
         vert = self._compile_shader(vertex_source, GL.GL_VERTEX_SHADER)
         frag = self._compile_shader(fragment_source, GL.GL_FRAGMENT_SHADER)
         if vert and frag:
@@ -44,54 +83,248 @@ class Shader:
                 GL.glDeleteProgram(self.glid)
                 self.glid = None
                 raise Exception('Shader linking failed')
+            self.resource = resources.track(self, 'program', partial(delete_program, self.glid))
+
+    def locations(self, *names):
+        """ uniform locations by name, looked up once per program """
+        for name in names:
+            if name not in self.uniforms:
+                self.uniforms[name] = GL.glGetUniformLocation(self.glid, name)
+        return self.uniforms
+
+    def bind_block(self, name, binding):
+        """ attach uniform block 'name' to binding point, if the program has it """
+        index = GL.glGetUniformBlockIndex(self.glid, name)
+        if index != GL.GL_INVALID_INDEX:
+            GL.glUniformBlockBinding(self.glid, index, binding)
+        return index != GL.GL_INVALID_INDEX
 
-    def __del__(self):
-        GL.glUseProgram(0)
-        if self.glid:  # if this is a valid shader object
-            GL.glDeleteProgram(self.glid)  # object dies => destroy GL object
+
+class Attribute:
+    """ vertex attribute already in its GL format: data has one row per
+        vertex, read by the shader as 'size' components of 'gl_type' """
+
+    def __init__(self, data, gl_type=GL.GL_FLOAT, size=None, normalized=False):
+        self.data = np.asarray(data)
+        self.gl_type, self.normalized = gl_type, normalized
+        self.size = size or self.data.reshape(len(self.data), -1).shape[1]
 
 
 class VertexArray:
-    """ helper class to create and self destroy OpenGL vertex array objects."""
+    """ helper class to create and release OpenGL vertex array objects."""
 
-    def __init__(self, attributes, index=None, usage=GL.GL_STATIC_DRAW):
+    def __init__(self, attributes, index=None, usage=GL.GL_STATIC_DRAW, dequantize=None, reload=None):
         """ Vertex array from attributes and optional index array. Vertex
-            Attributes should be list of arrays with one row per vertex. """
+            Attributes should be list of arrays with one row per vertex, or
+            packed Attributes. dequantize is the matrix bringing quantized
+            positions back in model space, applied before the model matrix.
+            With reload() returning (attributes, index) again, the buffers
+            can be evicted from the GPU and are re-created when next used """
+        self.usage, self.dequantize, self.reload = usage, dequantize, reload
+        self.users = weakref.WeakSet()  # instanced vertex arrays sharing our buffers
+        self.resource = resources.track(self, 'mesh', evictable=reload is not None)
+        self._upload(attributes, index)
 
+    def _upload(self, attributes, index):
         # create vertex array object, bind it
         self.glid = GL.glGenVertexArrays(1)
-        GL.glBindVertexArray(self.glid)
+        gl.bind_vertex_array(self.glid)
         self.buffers = []  # we will store buffers in a list
-        nb_primitives, size = 0, 0
-
-        # load buffer per vertex attribute (in list with index = shader layout)
-        for loc, data in enumerate(attributes):
-            if data is not None:
-                # bind a new vbo, upload its data to GPU, declare size and type
-                self.buffers.append(GL.glGenBuffers(1))
-                data = np.array(data, np.float32, copy=False)  # ensure format
-                nb_primitives, size = data.shape
+        # (shader location, buffer, size, stride, offset, type, normalized)
+        self.layout = []
+        self.index_buffer = None
+        self.nbytes = 0  # GPU memory of the buffers
+        nb_primitives = 0
+
+        # attributes interleaved in a single vbo, one row of all per vertex
+        # (in list with index = shader layout), each one 4 bytes aligned
+        columns = [(loc, data if isinstance(data, Attribute) else
+                    Attribute(np.asarray(data, np.float32)))  # ensure format
+                   for loc, data in enumerate(attributes) if data is not None]
+        if columns:
+            nb_primitives = len(columns[0][1].data)
+            rows = []
+            for _, attribute in columns:
+                raw = np.ascontiguousarray(attribute.data).reshape(nb_primitives, -1)
+                raw = raw.view(np.uint8).reshape(nb_primitives, -1)
+                rows.append(np.pad(raw, ((0, 0), (0, -raw.shape[1] % 4))))
+            vertices = np.ascontiguousarray(np.hstack(rows))
+            stride = vertices.shape[1]
+            self.buffers.append(GL.glGenBuffers(1))
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[-1])
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, vertices, self.usage)
+            self.nbytes += vertices.nbytes
+            offset = 0
+            for (loc, attribute), raw in zip(columns, rows):
                 GL.glEnableVertexAttribArray(loc)
-                GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[-1])
-                GL.glBufferData(GL.GL_ARRAY_BUFFER, data, usage)
-                GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False, 0, None)
+                GL.glVertexAttribPointer(loc, attribute.size, attribute.gl_type, attribute.normalized,
+                                         stride, ctypes.c_void_p(offset))
+                self.layout.append((loc, self.buffers[-1], attribute.size, stride, offset,
+                                    attribute.gl_type, attribute.normalized))
+                offset += raw.shape[1]
 
         # optionally create and upload an index buffer for this object
         self.draw_command = GL.glDrawArrays
         self.arguments = (0, nb_primitives)
         if index is not None:
             self.buffers += [GL.glGenBuffers(1)]
-            index_buffer = np.array(index, np.int32, copy=False)  # good format
+            self.index_buffer = self.buffers[-1]
+            # 16 bit indices are kept, anything else becomes 32 bit
+            index_buffer = np.asarray(index)
+            if index_buffer.dtype != np.uint16:
+                index_buffer = index_buffer.astype(np.uint32)  # good format
             GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, self.buffers[-1])
-            GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index_buffer, usage)
+            GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index_buffer, self.usage)
+            self.nbytes += index_buffer.nbytes
             self.draw_command = GL.glDrawElements
-            self.arguments = (index_buffer.size, GL.GL_UNSIGNED_INT, None)
+            index_type = GL.GL_UNSIGNED_SHORT if index_buffer.dtype == np.uint16 else GL.GL_UNSIGNED_INT
+            self.arguments = (index_buffer.size, index_type, None)
+        resources.loaded(self.resource, partial(delete_vertex_array, self.glid, list(self.buffers)), self.nbytes)
+
+    def use(self):
+        """ GL id of the vertex array, re-created if it was evicted """
+        if self.glid is None:
+            self._upload(*self.reload())
+        resources.touch(self.resource)
+        return self.glid
+
+    def evict(self):
+        """ free the GPU buffers until the vertex array is used again """
+        for user in list(self.users):
+            user.detach()
+        resources.unload(self.resource)
+        self.glid, self.buffers, self.layout, self.index_buffer = None, [], [], None
 
     def execute(self, primitive):
         """ draw a vertex array, either as direct array or indexed array """
-        GL.glBindVertexArray(self.glid)
+        gl.bind_vertex_array(self.use())
         self.draw_command(primitive, *self.arguments)
 
-    def __del__(self):  # object dies => kill GL array and buffers from GPU
-        GL.glDeleteVertexArrays(1, [self.glid])
-        GL.glDeleteBuffers(len(self.buffers), self.buffers)
+
+class UniformBuffer:
+    """ buffer backing a std140 uniform block, shared by every program whose
+        block is attached to the binding point it is bound to """
+
+    def __init__(self, size, binding=None, usage=GL.GL_DYNAMIC_DRAW):
+        self.glid = GL.glGenBuffers(1)
+        self.size = size
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+        GL.glBufferData(GL.GL_UNIFORM_BUFFER, size, None, usage)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, 0)
+        self.resource = resources.track(self, 'uniform', partial(delete_buffers, [self.glid]), size)
+        if binding is not None:
+            self.bind(binding)
+
+    def update(self, data):
+        """ upload data, a float32 array already laid out following std140 """
+        data = np.ascontiguousarray(data, np.float32)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+        GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, 0, data.nbytes, data)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, 0)
+
+    def bind(self, binding):
+        gl.bind_uniform_buffer(binding, self.glid)
+
+
+class TextureBuffer:
+    """ buffer read by shaders as an array of texels of the given internal
+        format with texelFetch, through a buffer texture """
+
+    def __init__(self, internal_format, usage=GL.GL_STREAM_DRAW):
+        self.internal_format, self.usage = internal_format, usage
+        self.glid = GL.glGenTextures(1)
+        self.buffer = GL.glGenBuffers(1)
+        self.resource = resources.track(self, 'texture buffer', partial(delete_texture_buffer, self.glid, self.buffer))
+        self.capacity = 0
+        self.update(())
+
+    def update(self, data):
+        """ upload data, already in the texel format, growing the buffer if needed """
+        data = np.ascontiguousarray(data)
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, self.buffer)
+        if max(data.nbytes, 16) > self.capacity:  # never empty, GL needs a store
+            self.capacity = max(data.nbytes, 16, 2 * self.capacity)
+            GL.glBufferData(GL.GL_TEXTURE_BUFFER, self.capacity, None, self.usage)
+            gl.bind_texture(GL.GL_TEXTURE_BUFFER, self.glid)
+            GL.glTexBuffer(GL.GL_TEXTURE_BUFFER, self.internal_format, self.buffer)
+            resources.resize(self.resource, self.capacity)
+        if data.nbytes:
+            GL.glBufferSubData(GL.GL_TEXTURE_BUFFER, 0, data.nbytes, data)
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, 0)
+
+
+class InstancedVertexArray:
+    """ vertex array drawing the buffers of another VertexArray many times in
+        one call, with one model matrix per instance read from its own buffer """
+
+    def __init__(self, vertex_array, matrices=(), loc=3, usage=GL.GL_DYNAMIC_DRAW):
+        """ Shares vertex_array buffers, matrices is a (N, 4, 4) array and the
+            mat4 instance attribute takes shader locations loc to loc+3 """
+        self.source = vertex_array  # keeps the shared buffers alive
+        self.dequantize = None      # the source's one is baked in the instances
+        self.loc, self.usage = loc, usage
+        self.glid = None            # created when drawn, see detach()
+        self.instance_buffer = GL.glGenBuffers(1)
+        # current objects, read by the deletion when the array dies
+        self.names = {'vertex_array': None, 'buffer': self.instance_buffer}
+        self.resource = resources.track(self, 'instances', partial(delete_instanced, self.names))
+        self.capacity, self.count = 0, 0
+        self.update(matrices)
+
+    def _bind(self):
+        """ vertex array reading the source buffers and the instance buffer """
+        self.glid = self.names['vertex_array'] = GL.glGenVertexArrays(1)
+        gl.bind_vertex_array(self.glid)
+        for attr_loc, buffer, size, stride, offset, gl_type, normalized in self.source.layout:
+            GL.glEnableVertexAttribArray(attr_loc)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+            GL.glVertexAttribPointer(attr_loc, size, gl_type, normalized, stride, ctypes.c_void_p(offset))
+        if self.source.index_buffer is not None:
+            GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, self.source.index_buffer)
+
+        # a mat4 attribute is 4 vec4 columns, each advancing once per instance
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.instance_buffer)
+        for col in range(4):
+            GL.glEnableVertexAttribArray(self.loc + col)
+            GL.glVertexAttribPointer(self.loc + col, 4, GL.GL_FLOAT, False, 64, ctypes.c_void_p(16 * col))
+            GL.glVertexAttribDivisor(self.loc + col, 1)
+        gl.bind_vertex_array(0)
+        self.source.users.add(self)
+
+    def detach(self):
+        """ delete our vertex array before the source buffers are evicted, as
+            GL keeps buffers alive while a vertex array reads them """
+        if self.glid is not None:
+            delete_vertex_array(self.glid)
+            self.glid = self.names['vertex_array'] = None
+
+    def update(self, matrices):
+        """ upload new instance model matrices, growing the buffer if needed """
+        matrices = np.asarray(matrices, np.float32).reshape(-1, 4, 4)
+        if self.source.dequantize is not None:  # baked in each instance matrix
+            matrices = matrices @ self.source.dequantize
+        # numpy matrices are row major, GLSL reads attributes column by column
+        data = np.ascontiguousarray(matrices.transpose(0, 2, 1))
+        self.count = len(data)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.instance_buffer)
+        if self.count > self.capacity:
+            self.capacity = max(self.count, 2 * self.capacity)
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, self.capacity * 64, None, self.usage)
+            resources.resize(self.resource, self.capacity * 64)
+        if self.count:
+            GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, data.nbytes, data)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+    def execute(self, primitive):
+        """ draw all instances, either as direct array or indexed array """
+        if not self.count:
+            return
+        self.source.use()  # reloads evicted buffers, which detached us
+        if self.glid is None:
+            self._bind()
+        gl.bind_vertex_array(self.glid)
+        if self.source.draw_command == GL.glDrawElements:
+            nb_indices, index_type, _ = self.source.arguments
+            GL.glDrawElementsInstanced(primitive, nb_indices, index_type, None, self.count)
+        else:
+            GL.glDrawArraysInstanced(primitive, *self.source.arguments, self.count)
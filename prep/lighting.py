@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# clustered light culling: the view frustum is split in a grid of clusters,
+# tiles on screen times exponential depth slices, each listing the point
+# lights whose sphere of influence reaches it
+
+import numpy as np
+
+CLUSTER_DIMS = (16, 9, 24)  # tiles along x and y, depth slices
+CUTOFF = 1 / 256            # light intensity under which it is ignored
+
+
+def light_radii(attenuations, colors, ranges=None, cutoff=CUTOFF):
+    """ (radius, attenuation cutoff) of each light: distance where the
+        constant, linear, quadratic attenuation of its brightest color
+        channel drops to cutoff, or the light's explicit range if shorter,
+        and the attenuation value there """
+    c, l, q = np.asarray(attenuations, np.float64).reshape(-1, 3).T
+    brightest = np.asarray(colors, np.float64).reshape(-1, 3).max(axis=1)
+    thresholds = np.minimum(cutoff / np.maximum(brightest, 1e-12), 0.99)  # < 1, shader divides by 1 - it
+    k = np.maximum(1 / thresholds - c, 0)  # q d^2 + l d = k at the radius
+    with np.errstate(divide='ignore', invalid='ignore'):
+        radii = np.where(q > 0, (-l + np.sqrt(l * l + 4 * q * k)) / (2 * q),
+                         np.where(l > 0, k / np.where(l > 0, l, 1), np.inf))
+    if ranges is not None:
+        # the attenuation is windowed to reach zero at the shorter range
+        ranges = np.broadcast_to(np.asarray(ranges, np.float64), radii.shape)
+        shorter = ranges < radii
+        radii = np.where(shorter, ranges, radii)
+        at_range = 1 / np.maximum(c + l * radii + q * radii * radii, 1e-12)
+        thresholds = np.where(shorter, np.minimum(at_range, 0.99), thresholds)
+    return radii, thresholds
+
+
+def slice_params(near, far, slices):
+    """ (scale, bias) giving the depth slice of view depth d as
+        floor(log(d) * scale + bias), slices growing exponentially """
+    scale = slices / np.log(far / near)
+    return scale, -np.log(near) * scale
+
+
+def _tiles(scale, shift, coords, depths, radii, count):
+    """ (N, count) mask of the lights reaching each tile column (or row).
+        Tile bounds are planes through the eye, NDC coordinate a being the
+        plane scale * x + (shift + a) * z = 0 in view space """
+    bounds = np.linspace(-1, 1, count + 1)
+    slopes = shift + bounds
+    distances = (scale * coords[:, np.newaxis] - slopes * depths[:, np.newaxis]) / np.hypot(scale, slopes)
+    return (distances[:, :-1] >= -radii[:, np.newaxis]) & (distances[:, 1:] <= radii[:, np.newaxis])
+
+
+def assign_lights(projection, view, positions, radii, near, far, dims=CLUSTER_DIMS):
+    """ lights of each cluster for a perspective projection, as (grid,
+        indices): grid (X * Y * Z, 2) uint32 offset & count in indices, the
+        uint32 light numbers grouped by cluster, cluster x + X * (y + Y * z).
+        Tests are conservative, a light may be listed in a cluster it misses """
+    nx, ny, nz = dims
+    positions = np.asarray(positions, np.float64).reshape(-1, 3)
+    radii = np.asarray(radii, np.float64).reshape(-1)
+    centers = positions @ np.asarray(view[:3, :3], np.float64).T + np.asarray(view[:3, 3], np.float64)
+    depths = -centers[:, 2]
+
+    mask_x = _tiles(projection[0, 0], projection[0, 2], centers[:, 0], depths, radii, nx)
+    mask_y = _tiles(projection[1, 1], projection[1, 2], centers[:, 1], depths, radii, ny)
+    bounds = near * (far / near) ** (np.arange(nz + 1) / nz)
+    mask_z = ((depths + radii)[:, np.newaxis] >= bounds[:-1]) & ((depths - radii)[:, np.newaxis] <= bounds[1:])
+
+    # only the lights reaching the frustum take part in the full grid
+    seen = np.flatnonzero(mask_x.any(axis=1) & mask_y.any(axis=1) & mask_z.any(axis=1))
+    mask = (mask_z[seen].T[:, np.newaxis, np.newaxis, :] & mask_y[seen].T[np.newaxis, :, np.newaxis, :]
+            & mask_x[seen].T[np.newaxis, np.newaxis, :, :])
+    clusters, lights = np.divmod(np.flatnonzero(mask), len(seen))  # sorted by cluster
+    counts = np.bincount(clusters, minlength=nx * ny * nz)
+    grid = np.stack([np.cumsum(counts) - counts, counts], axis=1).astype(np.uint32)
+    return grid, seen[lights].astype(np.uint32)
@@ -2,63 +2,159 @@
 
 import assimpcy  # 3D resource loader
 import os  # os function, i.e. checking file status
-
-from material import Texture, TexturedPhongMesh, CubeMap, CubeMapMesh, FrameTexture, FramebufferMesh, TexturedPlaneMesh, AxisMesh
-
-
-def load_model(file, shader, dlight_dir, tex_file=None):
-    """ load resources from file using assimp, return list of Meshes"""
-    try:
-        pp = assimpcy.aiPostProcessSteps
-        flags = pp.aiProcess_Triangulate | pp.aiProcess_GenSmoothNormals | pp.aiProcess_FlipUVs
-        scene = assimpcy.aiImportFile(file, flags)
-    except assimpcy.all.AssimpError as exception:
-        print('ERROR loading', file + ': ', exception.args[0].decode())
-        return []
+import numpy as np
+
+import fileindex
+import meshcache
+import meshopt
+import quantize
+import simplify
+import texcache
+from assets import registry, file_key
+from gpu import VertexArray
+from material import Texture, PhongMaterial, TexturedPhongMesh, CubeMap, CubeMapMesh, FrameTexture, FramebufferMesh, TexturedPlaneMesh, AxisMesh
+
+
+pp = assimpcy.aiPostProcessSteps
+MODEL_FLAGS = pp.aiProcess_Triangulate | pp.aiProcess_GenSmoothNormals | pp.aiProcess_FlipUVs
+
+pipeline = None  # pipeline.AssetPipeline loading models in the background, if set
+
+
+def load_texture(tex_file, levels=None):
+    """ shared texture for tex_file, uploaded once for all the models using it """
+    return registry.acquire(file_key('texture', tex_file), lambda: Texture(tex_file=tex_file, levels=levels))
+
+
+def import_model(file, flags=MODEL_FLAGS, lod_ratios=simplify.LOD_RATIOS):
+    """ post-processed mesh arrays, their simplified levels of detail and
+        material properties of a model, from the binary mesh cache when
+        possible, otherwise imported with assimp, optimized for the vertex
+        cache and simplified """
+    def assimp_import():
+        try:
+            scene = assimpcy.aiImportFile(file, flags)
+        except assimpcy.all.AssimpError as exception:
+            print('ERROR loading', file + ': ', exception.args[0].decode())
+            return {'materials': [], 'meshes': []}
+        meshes = [{'material': mesh.mMaterialIndex,
+                   'arrays': {'vertices': mesh.mVertices, 'normals': mesh.mNormals,
+                              'tex_coords': mesh.mTextureCoords[0], 'faces': mesh.mFaces}}
+                  for mesh in scene.mMeshes]
+        for mesh in meshes:
+            mesh['arrays'] = meshopt.optimize(mesh['arrays'])[0]
+            mesh['lods'] = [meshopt.optimize(lod, count=False)[0] for lod in simplify.lod_chain(mesh['arrays'], lod_ratios)]
+        return {'materials': [dict(mat.properties) for mat in scene.mMaterials], 'meshes': meshes}
+
+    return meshcache.load(file, flags, assimp_import, lod_ratios, meshopt.CACHE_SIZE)
+
+
+def find_texture(name, path):
+    """ texture file 'name' in path's whole subtree, since path often screwed up """
+    found = fileindex.index().find(name, path)
+    assert found, 'Cannot find texture %s in %s subtree' % (name, path)
+    return found[0]
+
+
+def mesh_bounds(vertices):
+    """ bounding sphere and box of vertices: (center, radius, (lower, upper)) """
+    vertices = np.asarray(vertices, np.float32).reshape(-1, 3)
+    if not len(vertices):
+        return np.zeros(3, np.float32), 0.0, (np.zeros(3, np.float32), np.zeros(3, np.float32))
+    lower, upper = vertices.min(axis=0), vertices.max(axis=0)
+    center = (lower + upper) / 2
+    radius = float(np.sqrt(((vertices - center) ** 2).sum(axis=1).max()))
+    return center, radius, (lower, upper)
+
+
+def prepare_model(file, flags=MODEL_FLAGS, tex_file=None):
+    """ CPU side of loading a model, safe in any thread: mesh arrays and
+        materials, texture file of each material and mapped texture mip chains """
+    model = import_model(file, flags)
+    for mesh in model['meshes']:
+        mesh['bounds'] = mesh_bounds(mesh['arrays']['vertices'])
 
     path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
-    for mat in scene.mMaterials:
-        if not tex_file and 'TEXTURE_BASE' in mat.properties:  # texture token
-            name = os.path.basename(mat.properties['TEXTURE_BASE'])
-            # search texture in file's whole subdir since path often screwed up
-            paths = os.walk(path, followlinks=True)
-            found = [os.path.join(d, f) for d, _, n in paths for f in n
-                     if name.startswith(f) or f.startswith(name)]
-            assert found, 'Cannot find texture %s in %s subtree' % (name, path)
-            tex_file = found[0]
+    tex_files = []
+    for mat in model['materials']:
+        if not tex_file and 'TEXTURE_BASE' in mat:  # texture token
+            tex_file = find_texture(os.path.basename(mat['TEXTURE_BASE']), path)
+        tex_files.append(tex_file)
+
+    # textures already shared by another model need no loading
+    images = {f: texcache.load(f) for f in set(tex_files)
+              if f and file_key('texture', f) not in registry}
+    return model, tex_files, images
+
+
+def upload_arrays(arrays):
+    """ vertex array of mesh arrays, in the compact formats chosen for them.
+        Once evicted, it is encoded again from the memory mapped mesh cache """
+    attributes, faces, dequantize = quantize.encode(arrays)
+    return VertexArray(attributes, faces, dequantize=dequantize,
+                       reload=lambda: quantize.encode(arrays, count=False)[:2])
+
+
+def upload_model(prepared, shader, dlight_dir):
+    """ GL side of loading a model from prepare_model(), in the context's
+        thread, return list of Meshes """
+    model, tex_files, images = prepared
+    materials = [dict(mat) for mat in model['materials']]
+    for mat, tex_file in zip(materials, tex_files):
         if tex_file:
-            mat.properties['diffuse_map'] = Texture(tex_file=tex_file)
-
-    # prepare mesh nodes
+            mat['diffuse_map'] = load_texture(tex_file, images.get(tex_file))
+        # one uniform buffer per material, whatever its number of meshes
+        mat['phong'] = PhongMaterial(k_d=mat.get('COLOR_DIFFUSE', (1, 1, 1)),
+                                     k_s=mat.get('COLOR_SPECULAR', (1, 1, 1)),
+                                     k_a=mat.get('COLOR_AMBIENT', (0, 0, 0)),
+                                     s=mat.get('SHININESS', 16.))
+
+    # prepare mesh nodes, coarser levels of detail listed in mesh.lods
     meshes = []
-    for mesh in scene.mMeshes:
-        mat = scene.mMaterials[mesh.mMaterialIndex].properties
+    for entry in model['meshes']:
+        mat = materials[entry['material']]
         assert mat['diffuse_map'], "Trying to map using a textureless material"
-        attributes = [mesh.mVertices, mesh.mNormals, mesh.mTextureCoords[0]]
-        mesh = TexturedPhongMesh(shader, mat['diffuse_map'], attributes,
-                                 dlight_dir, mesh.mFaces,
-                                 k_d=mat.get('COLOR_DIFFUSE', (1, 1, 1)),
-                                 k_s=mat.get('COLOR_SPECULAR', (1, 1, 1)),
-                                 k_a=mat.get('COLOR_AMBIENT', (0, 0, 0)),
-                                 s=mat.get('SHININESS', 16.),
-                                 )
-        meshes.append(mesh)
+        levels = [TexturedPhongMesh(shader, mat['diffuse_map'], None, dlight_dir,
+                                    vertex_array=upload_arrays(arrays),
+                                    material=mat['phong'], bounds=entry['bounds'])
+                  for arrays in [entry['arrays']] + entry.get('lods', [])]
+        levels[0].lods = levels
+        meshes.append(levels[0])
 
-    size = sum((mesh.mNumFaces for mesh in scene.mMeshes))
     return meshes
 
 
+def load_model(file, shader, dlight_dir, tex_file=None, flags=MODEL_FLAGS):
+    """ load resources from file using assimp, return list of Meshes"""
+    return upload_model(prepare_model(file, flags, tex_file), shader, dlight_dir)
+
+
+def acquire_model(file, shader, dlight_dir, flags=MODEL_FLAGS, callback=None):
+    """ shared meshes of a model, imported and uploaded once per shader and
+        flags whatever the number of instances, returns (key, meshes).
+        With a callback and a background pipeline, returns at once with
+        meshes None and callback(meshes) runs once they are uploaded, or
+        callback(None) if they could not be loaded """
+    key = file_key('model', file, flags, shader.glid)
+    if pipeline is None or callback is None:
+        meshes = registry.acquire(key, lambda: load_model(file, shader, dlight_dir, flags=flags))
+        if callback is not None:
+            callback(meshes)
+        return key, meshes
+
+    def start(finish, fail):
+        pipeline.submit(lambda: prepare_model(file, flags),
+                        lambda prepared: finish(lambda: upload_model(prepared, shader, dlight_dir)), fail)
+    registry.acquire_async(key, start, callback)
+    return key, None
+
+
 def load_cubemap(files, shader):
     """ load resources from file using assimp, return list of Meshes"""
     tex_files = []
     for file in files:
         path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
-        name = os.path.basename(file)
-        paths = os.walk(path, followlinks=True)
-        found = [os.path.join(d, f) for d, _, n in paths for f in n
-                    if name.startswith(f) or f.startswith(name)]
-        assert found, 'Cannot find texture %s in %s subtree' % (name, path)
-        tex_files.append(found[0])
+        tex_files.append(find_texture(os.path.basename(file), path))
     assert len(tex_files) == 6, '6 textures are needed for cubemap'
     file_order = ['_rt', '_lf', '_up', '_dn', '_ft', '_bk']
     cmap_textures = []
@@ -82,9 +178,7 @@ def load_framebuffer(shader, width, height):
 def load_floor(file, shader, tex_file=None):
     """ load resources from file using assimp, return list of Meshes"""
     try:
-        pp = assimpcy.aiPostProcessSteps
-        flags = pp.aiProcess_Triangulate | pp.aiProcess_GenSmoothNormals | pp.aiProcess_FlipUVs
-        scene = assimpcy.aiImportFile(file, flags)
+        scene = assimpcy.aiImportFile(file, MODEL_FLAGS)
     except assimpcy.all.AssimpError as exception:
         print('ERROR loading', file + ': ', exception.args[0].decode())
         return []
@@ -92,13 +186,7 @@ def load_floor(file, shader, tex_file=None):
     path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
     for mat in scene.mMaterials:
         if not tex_file and 'TEXTURE_BASE' in mat.properties:  # texture token
-            name = os.path.basename(mat.properties['TEXTURE_BASE'])
-            # search texture in file's whole subdir since path often screwed up
-            paths = os.walk(path, followlinks=True)
-            found = [os.path.join(d, f) for d, _, n in paths for f in n
-                     if name.startswith(f) or f.startswith(name)]
-            assert found, 'Cannot find texture %s in %s subtree' % (name, path)
-            tex_file = found[0]
+            tex_file = find_texture(os.path.basename(mat.properties['TEXTURE_BASE']), path)
 
     mesh = TexturedPlaneMesh(shader, tex_file)
 
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# level of detail selection from projected size, see simplify.lod_chain
+
+import numpy as np
+
+# projected size below which each coarser level is used, as a fraction of the
+# half viewport height. Levels only change once the size leaves the band of
+# +/- HYSTERESIS around a threshold, so that they don't flicker
+LOD_SIZES = (0.25, 0.1, 0.04)
+HYSTERESIS = 0.15
+
+
+def merge_spheres(spheres):
+    """ (center, radius) of a sphere enclosing all the (center, radius, ...) """
+    spheres = list(spheres)
+    centers = np.array([sphere[0] for sphere in spheres], np.float32).reshape(-1, 3)
+    radii = np.array([sphere[1] for sphere in spheres], np.float32)
+    center = (centers.min(axis=0) + centers.max(axis=0)) / 2 if len(centers) else np.zeros(3, np.float32)
+    radius = float((np.linalg.norm(centers - center, axis=1) + radii).max()) if len(radii) else 0.0
+    return center, radius
+
+
+def projected_sizes(projection, view, centers, radii):
+    """ projected radius of world space spheres, in half viewport heights """
+    centers, radii = np.asarray(centers).reshape(-1, 3), np.asarray(radii).reshape(-1)
+    depths = -(centers @ np.asarray(view[2, :3], centers.dtype) + view[2, 3])
+    return radii * projection[1, 1] / np.maximum(depths, np.maximum(radii, 1e-6))
+
+
+def select_levels(sizes, current=None, thresholds=LOD_SIZES, hysteresis=HYSTERESIS):
+    """ level of detail of each projected size, 0 being the finest. With the
+        current levels, a level only changes when the size is clearly past
+        the thresholds separating it from the new one """
+    sizes, thresholds = np.asarray(sizes)[:, np.newaxis], np.asarray(thresholds)
+    if current is None or len(current) != len(sizes):
+        return (sizes < thresholds).sum(axis=1)
+    finest = (sizes < thresholds * (1 - hysteresis)).sum(axis=1)
+    coarsest = (sizes < thresholds * (1 + hysteresis)).sum(axis=1)
+    return np.clip(current, finest, coarsest)
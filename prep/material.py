@@ -1,75 +1,123 @@
 #!/usr/bin/env python3
 
 import numpy as np  # all matrix manipulations & OpenGL args
-from PIL import Image               # load images for textures
 import OpenGL.GL as GL
 import glfw
+from functools import partial
 from itertools import cycle
 
 from model import Mesh
+from gpu import InstancedVertexArray, TextureBuffer, UniformBuffer
+from glstate import gl
+from resources import resources
+import lighting
 import sh_var_lst as svl
-from camera import get_camera_position
+import texcache
 import transform as t
 
+MIPMAP_FILTERS = (GL.GL_NEAREST_MIPMAP_NEAREST, GL.GL_LINEAR_MIPMAP_NEAREST,
+                  GL.GL_NEAREST_MIPMAP_LINEAR, GL.GL_LINEAR_MIPMAP_LINEAR)
+
 
 # -------------- OpenGL Texture Wrapper ---------------------------------------
+def upload_levels(target, levels, mipmaps=True):
+    """ copy mip chain levels finest first, straight from their memory map,
+        to the bound texture target. Without mipmaps only the base is used """
+    levels = levels if mipmaps else levels[:1]
+    for level, pixels in enumerate(levels):
+        GL.glTexImage2D(target, level, GL.GL_RGBA, pixels.shape[1], pixels.shape[0], 0,
+                        GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, pixels)
+    return len(levels) - 1
+
+
+def delete_textures(*glids):
+    gl.forget(*glids)
+    GL.glDeleteTextures(glids)
+
+
+def delete_framebuffer(fbid, tcid, rbid):
+    gl.forget(fbid, tcid)
+    GL.glDeleteFramebuffers(1, [fbid])
+    GL.glDeleteTextures(tcid)
+    GL.glDeleteRenderbuffers(1, [rbid])
+
+
 class Texture:
-    """ Helper class to create and automatically destroy textures """
+    """ Helper class to create and release textures, which can be evicted
+        from the GPU and reload from the texture cache when used again """
     def __init__(self, tex_file, wrap_mode=GL.GL_REPEAT, min_filter=GL.GL_LINEAR,
-                 mag_filter=GL.GL_LINEAR_MIPMAP_LINEAR):
+                 mag_filter=GL.GL_LINEAR_MIPMAP_LINEAR, levels=None):
+        self.tex_file, self.wrap_mode = tex_file, wrap_mode
+        self.min_filter, self.mag_filter = min_filter, mag_filter
+        self.resource = resources.track(self, 'texture', evictable=True)
+        self._upload(levels)
+
+    def _upload(self, levels=None):
         self.glid = GL.glGenTextures(1)
+        nbytes = 0
         try:
-            # imports image as a numpy array in exactly right format
-            tex = np.asarray(Image.open(tex_file).convert('RGBA'))
-            GL.glBindTexture(GL.GL_TEXTURE_2D, self.glid)
-            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, tex.shape[1],
-                            tex.shape[0], 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex)
-            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, wrap_mode)
-            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, wrap_mode)
-            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, min_filter)
-            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, mag_filter)
-            GL.glGenerateMipmap(GL.GL_TEXTURE_2D)
+            # mip chain from the texture cache, unless it was already loaded
+            # by a loading thread
+            levels = texcache.load(self.tex_file) if levels is None else levels
+            gl.bind_texture(GL.GL_TEXTURE_2D, self.glid)
+            max_level = upload_levels(GL.GL_TEXTURE_2D, levels, self.mag_filter in MIPMAP_FILTERS)
+            nbytes = sum(level.nbytes for level in levels[:max_level + 1])
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAX_LEVEL, max_level)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, self.wrap_mode)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, self.wrap_mode)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, self.min_filter)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, self.mag_filter)
         except FileNotFoundError:
-            print("ERROR: unable to load texture file %s" % tex_file)
+            print("ERROR: unable to load texture file %s" % self.tex_file)
+        resources.loaded(self.resource, partial(delete_textures, self.glid), nbytes)
+
+    def use(self):
+        """ GL id of the texture, reloaded if it was evicted """
+        if self.glid is None:
+            self._upload()
+        resources.touch(self.resource)
+        return self.glid
 
-    def __del__(self):  # delete GL texture from GPU when object dies
-        GL.glDeleteTextures(self.glid)
+    def evict(self):
+        resources.unload(self.resource)
+        self.glid = None
 
 
 class CubeMap:
-    """ Helper class to create and automatically destroy textures """
+    """ Helper class to create and release cube map textures """
     def __init__(self, tex_files, wrap_mode=GL.GL_CLAMP_TO_EDGE, min_filter=GL.GL_LINEAR,
                  mag_filter=GL.GL_LINEAR):
         assert len(tex_files) == 6, "Cube Map should have 6 files"
         self.glid = GL.glGenTextures(1)
-        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.glid)
+        gl.bind_texture(GL.GL_TEXTURE_CUBE_MAP, self.glid)
+        max_level, nbytes = 0, 0
         for i, tex_file in enumerate(tex_files):
             try:
-                tex = np.asarray(Image.open(tex_file).convert('RGBA'))
-                GL.glTexImage2D(GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X + i, 0, GL.GL_RGBA, tex.shape[1], tex.shape[0], 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex)
-
+                levels = texcache.load(tex_file)
+                max_level = upload_levels(GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X + i, levels,
+                                          mag_filter in MIPMAP_FILTERS)
+                nbytes += sum(level.nbytes for level in levels[:max_level + 1])
             except FileNotFoundError:
                 print("ERROR: unable to load texture file %s" % tex_file)
 
+        GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MAX_LEVEL, max_level)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MIN_FILTER, mag_filter)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MAG_FILTER, min_filter)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_S, wrap_mode)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_T, wrap_mode)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_R, wrap_mode)
-
-    def __del__(self):  # delete GL texture from GPU when object dies
-        GL.glDeleteTextures(self.glid)
+        self.resource = resources.track(self, 'texture', partial(delete_textures, self.glid), nbytes)
 
 
 class FrameTexture:
     def __init__(self, width, height, min_filter=GL.GL_LINEAR, mag_filter=GL.GL_LINEAR):
 
         self.fbid = GL.glGenFramebuffers(1)
-        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.fbid)
+        gl.bind_framebuffer(self.fbid)
 
 
         self.tcid = GL.glGenTextures(1)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self.tcid)
+        gl.bind_texture(GL.GL_TEXTURE_2D, self.tcid)
 
         GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, width, height, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, None)  # ctypes.c_void_p(0))
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, mag_filter)
@@ -86,15 +134,15 @@ class FrameTexture:
         GL.glDrawBuffers(1, GL.GL_COLOR_ATTACHMENT0);
 
         assert GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER) == GL.GL_FRAMEBUFFER_COMPLETE, "Framebuffer is not complete"
-        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
-
-    def __del__(self):  # delete GL texture from GPU when object dies
-        GL.glDeleteFramebuffers(1, self.fbid)
-        GL.glDeleteTextures(self.tcid)
-        GL.glDeleteRenderbuffers(1, self.rbid)
+        gl.bind_framebuffer(0)
+        # RGB color texture and 24 bit depth + 8 bit stencil buffer
+        self.resource = resources.track(self, 'framebuffer', partial(delete_framebuffer, self.fbid, self.tcid, self.rbid),
+                                        width * height * (3 + 4))
 
 
 class CubeMapMesh(Mesh):
+    render_pass = 'skybox'
+
     def __init__(self, shader, cubemap):
         pos = ((-1.0,  1.0, -1.0), (-1.0, -1.0, -1.0), ( 1.0, -1.0, -1.0), ( 1.0, -1.0, -1.0), ( 1.0,  1.0, -1.0), (-1.0,  1.0, -1.0),
                 (-1.0, -1.0,  1.0), (-1.0, -1.0, -1.0), (-1.0,  1.0, -1.0), (-1.0,  1.0, -1.0), (-1.0,  1.0,  1.0), (-1.0, -1.0,  1.0),
@@ -108,99 +156,200 @@ class CubeMapMesh(Mesh):
         self.loc.update(loc)
         self.cubemap = cubemap
 
-    def draw(self, projection, view, model, primitives=GL.GL_TRIANGLES):
-        GL.glDepthFunc(GL.GL_LEQUAL)
-        GL.glUseProgram(self.shader.glid)
+    def render(self, projection, view, model, primitives=GL.GL_TRIANGLES, **param):
+        gl.depth_func(GL.GL_LEQUAL)
+        gl.use_program(self.shader.glid)
         GL.glUniform1i(self.loc[svl.skybox], 0)
 
-        GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.cubemap.glid)
+        gl.bind_texture(GL.GL_TEXTURE_CUBE_MAP, self.cubemap.glid, unit=0)
 
         cmap_view = view[:3, :3]
         cmap_view = np.pad(cmap_view, [(0, 1), (0, 1)], mode='constant')
         cmap_view[3][3] = 1
-        super().draw(projection, cmap_view, t.identity(), primitives)
-        GL.glDepthFunc(GL.GL_LESS)
-        GL.glUseProgram(0)
+        super().render(projection, cmap_view, t.identity(), primitives)
+        gl.depth_func(GL.GL_LESS)
+
+
+# -------------- std140 uniform blocks of the world shader --------------------
+class FrameUniforms:
+    """ Per frame state shared by all the lit meshes: directional light,
+        camera, light cluster lookup and time, uploaded once per frame to
+        the FrameBlock uniform block """
+    LIGHT_SPEED = 0.001
+    LIGHT_FREQ = np.array((2.0, 0.7, 1.3), np.float32)
+
+    def __init__(self, near, far, dims=lighting.CLUSTER_DIMS):
+        # light_dir, camera_position, mat4 view_projection, vec4 cluster_dims,
+        # vec2 slice_scale_bias, float time
+        self.data = np.zeros(32, np.float32)
+        self.data[24:27] = dims
+        self.data[28:30] = lighting.slice_params(near, far, dims[2])
+        self.buffer = UniformBuffer(self.data.nbytes, svl.frame_binding)
+
+    def update(self, camera_pos, time, view_projection):
+        self.data[0:3] = np.sin(time * self.LIGHT_SPEED * self.LIGHT_FREQ)
+        self.data[4:7] = camera_pos
+        self.data[8:24] = np.asarray(view_projection).T.ravel()  # column major
+        self.data[30] = time
+        self.buffer.update(self.data)
+
+
+class ClusteredLights:
+    """ Point lights culled per cluster of the view frustum on the CPU each
+        frame. The lights, the (offset, count) of each cluster and the light
+        numbers they list go to texture buffers read by world.frag, so that
+        a fragment only shades the lights reaching its cluster """
+    def __init__(self, near, far, positions=svl.p_pos, colors=svl.p_color,
+                 attenuations=svl.p_attenuation, ranges=None, dims=lighting.CLUSTER_DIMS):
+        self.near, self.far, self.dims = near, far, dims
+        self.lights = TextureBuffer(GL.GL_RGBA32F)  # 3 texels per light
+        self.grid = TextureBuffer(GL.GL_RG32UI)
+        self.indices = TextureBuffer(GL.GL_R32UI)
+        self.last_frame = (0, 0)  # (lights in view, most lights of a cluster)
+        self.set(positions, colors, attenuations, ranges)
+
+    def set(self, positions, colors=svl.p_color, attenuations=svl.p_attenuation, ranges=None):
+        """ replace the lights, colors, attenuations and ranges given per
+            light or shared. Lights reach down to lighting.CUTOFF, or only
+            to their range if shorter, their falloff then windowed to it """
+        self.positions = np.asarray(positions, np.float32).reshape(-1, 3)
+        colors = np.broadcast_to(np.asarray(colors, np.float32), self.positions.shape)
+        attenuations = np.broadcast_to(np.asarray(attenuations, np.float32), self.positions.shape)
+        self.radii, cutoffs = lighting.light_radii(attenuations, colors, ranges)
+        # position & radius, color, attenuation & value at the radius
+        data = np.zeros((len(self.positions), 3, 4), np.float32)
+        data[:, 0, :3], data[:, 0, 3] = self.positions, np.minimum(self.radii, np.finfo(np.float32).max)
+        data[:, 1, :3] = colors
+        data[:, 2, :3], data[:, 2, 3] = attenuations, cutoffs
+        self.lights.update(data)
+
+    def update(self, projection, view):
+        """ assign the lights to the clusters of this frame's frustum """
+        grid, indices = lighting.assign_lights(projection, view, self.positions, self.radii,
+                                               self.near, self.far, self.dims)
+        self.grid.update(grid)
+        self.indices.update(indices)
+        self.last_frame = (len(np.unique(indices)), int(grid[:, 1].max()))
+        for unit, buffer in zip(svl.light_units, (self.lights, self.grid, self.indices)):
+            gl.bind_texture(GL.GL_TEXTURE_BUFFER, buffer.glid, unit=unit)
+        return self.last_frame
+
+
+class PhongMaterial:
+    """ Phong constants in their own MaterialBlock buffer, shared by the
+        meshes of the material and only uploaded when they change """
+    def __init__(self, k_a=(0, 0, 0), k_d=(1, 1, 0), k_s=(1, 1, 1), s=16.):
+        self.data = np.zeros(12, np.float32)  # vec3 k_a, k_d, k_s then float s
+        self.buffer = UniformBuffer(self.data.nbytes)
+        self.k_a, self.k_d, self.k_s, self.s = None, None, None, None
+        self.set(k_a, k_d, k_s, s)
+
+    def set(self, k_a=None, k_d=None, k_s=None, s=None):
+        """ change some of the constants, uploading them if they differ """
+        self.k_a, self.k_d = self.k_a if k_a is None else k_a, self.k_d if k_d is None else k_d
+        self.k_s, self.s = self.k_s if k_s is None else k_s, self.s if s is None else s
+        data = np.zeros_like(self.data)
+        for offset, k in ((0, self.k_a), (4, self.k_d), (8, self.k_s)):
+            data[offset:offset + 3] = np.ravel(k)[:3]  # colors may come as rgba
+        data[11] = max(self.s, 0.001)
+        if not np.array_equal(data, self.data):  # never zero, s > 0
+            self.data = data
+            self.buffer.update(data)
+
+    def bind(self):
+        self.buffer.bind(svl.material_binding)
 
 
 class TexturedPhongMesh(Mesh):
     def __init__(self, shader, texture, attributes,
                  light_dir,  # directional light (in world coords)
                  index=None,
-                 k_a=(0, 0, 0), k_d=(1, 1, 0), k_s=(1, 1, 1), s=16.):
-        super().__init__(shader, attributes, index)
-        self._PhongInit(light_dir, k_a, k_d, k_s, s)
+                 k_a=(0, 0, 0), k_d=(1, 1, 0), k_s=(1, 1, 1), s=16., vertex_array=None,
+                 material=None, bounds=None):
+        super().__init__(shader, attributes, index, vertex_array)
+        self.bounds = bounds
+        self._PhongInit(light_dir, material or PhongMaterial(k_a, k_d, k_s, s))
         self._TexturedMeshInit(texture)
-        self.plight_pos = [(0.7, 0.2, 2.0),
-                           (2.3, -3.3, -4.0),
-                           (-4.0, 2.0, -12.0),
-                           (0.0, 0.0, -3.0)]
-        assert len(self.plight_pos) == svl.p_nb, 'Provide position for all point lights'
 
-    def draw(self, projection, view, model, primitives=GL.GL_TRIANGLES):
-        GL.glUseProgram(self.shader.glid)
+    def render(self, projection, view, model, primitives=GL.GL_TRIANGLES, **param):
+        gl.use_program(self.shader.glid)
 
         self._TexturedMeshDraw()
-        self._PhongDraw(get_camera_position())
-        super().draw(projection, view, model, primitives)
+        self.material.bind()
+        super().render(projection, view, model, primitives)
 
-        self._TexturedMeshPostDraw()
-        GL.glUseProgram(0)
+    def state_ids(self):
+        return self.shader.glid, self.texture.glid or 0, self.vertex_array.glid or 0
 
-    def _PhongInit(self, light_dir, k_a, k_d, k_s, s):
+    def _PhongInit(self, light_dir, material):
+        # lights and camera come from the per frame FrameBlock, point lights
+        # from the texture buffers of the ClusteredLights
         self.light_dir = light_dir
-        self.k_a, self.k_d, self.k_s, self.s = k_a, k_d, k_s, s
-
-        names = [svl.light_dir, svl.d_k_a, svl.s, svl.d_k_s, svl.d_k_d,
-                 svl.camera_position]
-
-        p_names = [svl.p_c, svl.p_l, svl.p_q,
-                   svl.p_k_a, svl.p_k_s, svl.p_k_d,
-                   svl.p_pos]
-        for i in range(svl.p_nb):
-            for name in p_names:
-                names.append(svl.get_plamp_i(i, name))
-
-        loc = {n: GL.glGetUniformLocation(self.shader.glid, n) for n in names}
-        self.loc.update(loc)
-
-    def _PhongDraw(self, camera_pos):
-        for i in range(svl.p_nb):
-            GL.glUniform3fv(self.loc[svl.get_plamp_i(i, svl.p_pos)], 1, self.plight_pos[i])
-            GL.glUniform1f(self.loc[svl.get_plamp_i(i, svl.p_c)], 1.0)
-            GL.glUniform1f(self.loc[svl.get_plamp_i(i, svl.p_l)], 0.09)
-            GL.glUniform1f(self.loc[svl.get_plamp_i(i, svl.p_q)], 0.032)
-            GL.glUniform3fv(self.loc[svl.get_plamp_i(i, svl.p_k_a)], 1, self.k_a)
-            GL.glUniform3fv(self.loc[svl.get_plamp_i(i, svl.p_k_d)], 1, self.k_d)
-            GL.glUniform3fv(self.loc[svl.get_plamp_i(i, svl.p_k_s)], 1, self.k_s)
-
-        speed = 0.001
-        self.light_dir = [np.sin(glfw.get_time() * speed * val) for val in [2.0, 0.7, 1.3]]
-        GL.glUniform3fv(self.loc[svl.light_dir], 1, self.light_dir)
-
-        GL.glUniform3fv(self.loc[svl.d_k_a], 1, self.k_a)
-        GL.glUniform3fv(self.loc[svl.d_k_d], 1, self.k_d)
-        GL.glUniform3fv(self.loc[svl.d_k_s], 1, self.k_s)
-        GL.glUniform1f(self.loc[svl.s], max(self.s, 0.001))
-
-        GL.glUniform3fv(self.loc[svl.camera_position], 1, camera_pos)
+        self.material = material
+        self.shader.bind_block(svl.frame_block, svl.frame_binding)
+        self.shader.bind_block(svl.material_block, svl.material_binding)
+        gl.use_program(self.shader.glid)
+        for name, unit in zip((svl.light_data, svl.cluster_grid, svl.light_index), svl.light_units):
+            GL.glUniform1i(GL.glGetUniformLocation(self.shader.glid, name), unit)
 
     def _TexturedMeshInit(self, texture):
         loc = {svl.diffuse_map: GL.glGetUniformLocation(self.shader.glid, svl.diffuse_map)}
         self.loc.update(loc)
         self.texture = texture
-
-    def _TexturedMeshDraw(self):
-        GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture.glid)
+        # samplers are program state, the diffuse map always reads unit 0
+        gl.use_program(self.shader.glid)
         GL.glUniform1i(self.loc[svl.diffuse_map], 0)
 
-    def _TexturedMeshPostDraw(self):
-        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+    def _TexturedMeshDraw(self):
+        gl.bind_texture(GL.GL_TEXTURE_2D, self.texture.use(), unit=0)
+
+
+class InstancedPhongMesh(TexturedPhongMesh):
+    """ Textured phong mesh drawn once per model matrix of a whole flock in a
+        single instanced draw call, sharing the buffers of an existing mesh """
+    instanced = True
+    def __init__(self, shader, mesh, matrices=()):
+        vertex_array = InstancedVertexArray(mesh.vertex_array)
+        super().__init__(shader, mesh.texture, None, mesh.light_dir,
+                         vertex_array=vertex_array, material=mesh.material, bounds=mesh.bounds)
+        self.set_instances(matrices)
+
+    def set_instances(self, matrices):
+        """ per instance model matrices, applied before the node's model.
+            They are uploaded when drawn, only the visible ones if culled """
+        self.matrices = np.asarray(matrices, np.float32).reshape(-1, 4, 4)
+        self.visible = None  # mask of the uploaded instances, None if outdated
+
+    def cull_instances(self, world, planes):
+        """ keep the instances whose bounding sphere under node matrix world
+            intersects the frustum planes, returns their number """
+        if self.bounds is None:
+            mask = np.ones(len(self.matrices), bool)
+        else:
+            centers, radii = t.transform_spheres(world @ self.matrices, *self.bounds[:2])
+            mask = t.spheres_in_frustum(planes, centers, radii)
+        if self.visible is None or not np.array_equal(mask, self.visible):
+            self.vertex_array.update(self.matrices[mask])
+            self.visible = mask
+        return int(mask.sum())
+
+    def _upload_all(self):
+        if self.visible is None:  # not culled, all instances drawn
+            self.vertex_array.update(self.matrices)
+            self.visible = np.ones(len(self.matrices), bool)
+
+    def render(self, projection, view, model, primitives=GL.GL_TRIANGLES, **param):
+        self._upload_all()
+        super().render(projection, view, model, primitives)
+
+    def render_depth(self, projection, view, model, shader):
+        self._upload_all()
+        super().render_depth(projection, view, model, shader)
 
 
 class FramebufferMesh(Mesh):
+    render_pass = 'screen'
+
     def __init__(self, shader, frame_tex, exposure=1.0):
         pos = ((-1.0,  1.0), (-1.0, -1.0), (1.0, -1.0), (-1.0, 1.0), ( 1.0, -1.0), (1.0,  1.0))
         tex = ((0.0, 1.0), (0.0, 0.0), (1.0, 0.0), (0.0, 1.0), (1.0, 0.0), (1.0, 1.0))
@@ -214,23 +363,25 @@ class FramebufferMesh(Mesh):
         self.effect = 6
         self.tim_f = 0
 
-    def draw(self, projection, view, model, primitives=GL.GL_TRIANGLES):
-        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
-        GL.glDepthMask(GL.GL_FALSE);
+    def render(self, projection, view, model, primitives=GL.GL_TRIANGLES, **param):
+        gl.bind_framebuffer(0)
+        gl.depth_mask(GL.GL_FALSE)
         GL.glClearColor(1, 1, 1, 1)
         GL.glClear(GL.GL_COLOR_BUFFER_BIT)
-        GL.glUseProgram(self.shader.glid)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self.frame_tex.tcid)
+        gl.use_program(self.shader.glid)
+        gl.bind_texture(GL.GL_TEXTURE_2D, self.frame_tex.tcid, unit=0)
         GL.glUniform1i(self.loc[svl.screen_texture], 0)
 
-        self.tim_f = glfw.get_time() * 2.5
+        self.tim_f = param.get('time', 0.0) * 2.5
         GL.glUniform1f(self.loc[svl.tim_f], self.tim_f)
         GL.glUniform1f(self.loc[svl.exposure], self.exposure)
         GL.glUniform1i(self.loc[svl.effect], self.effect)
 
-        super().draw(t.identity(), t.identity(), t.identity())
-        GL.glUseProgram(0)
-        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.frame_tex.fbid)
+        super().render(t.identity(), t.identity(), t.identity())
+        gl.bind_framebuffer(self.frame_tex.fbid)
+        # the world drawn next writes a fresh depth, tested by occlusion queries
+        gl.depth_mask(GL.GL_TRUE)
+        GL.glClear(GL.GL_DEPTH_BUFFER_BIT)
 
     def key_handler(self, key):
         # some interactive elements
@@ -284,14 +435,16 @@ class TexturedPlaneMesh(Mesh):
             self.filter_mode = next(self.filter)
             self.texture = Texture(self.tex_file, self.wrap_mode, *self.filter_mode)
 
-    def draw(self, projection, view, model, primitives=GL.GL_TRIANGLES):
-        GL.glUseProgram(self.shader.glid)
+    def render(self, projection, view, model, primitives=GL.GL_TRIANGLES, **param):
+        gl.use_program(self.shader.glid)
 
         # texture access setups
-        GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture.glid)
+        gl.bind_texture(GL.GL_TEXTURE_2D, self.texture.use(), unit=0)
         GL.glUniform1i(self.loc[svl.diffuse_map], 0)
-        super().draw(projection, view, model, primitives)
+        super().render(projection, view, model, primitives)
+
+    def state_ids(self):
+        return self.shader.glid, self.texture.glid or 0, self.vertex_array.glid or 0
 
 
 class AxisMesh(Mesh):
@@ -302,6 +455,10 @@ class AxisMesh(Mesh):
         col = ((1, 0, 0), (1, 0, 0), (0, 1, 0), (0, 1, 0), (0, 0, 1), (0, 0, 1))
         super().__init__(shader, [pos, col])
 
-    def draw(self, projection, view, model, primitives=GL.GL_LINES):
+    def render(self, projection, view, model, primitives=GL.GL_LINES, **param):
         model = t.scale(5)
-        super().draw(projection, view, model, primitives)
+        super().render(projection, view, model, primitives)
+
+    def render_depth(self, projection, view, model, shader, primitives=GL.GL_LINES):
+        """ same scaled lines as render(), or GL_EQUAL would drop them """
+        super().render_depth(projection, view, t.scale(5), shader, primitives)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# on-disk cache of post-processed mesh arrays, memory mapped when loaded
+#
+# file layout: MAGIC, uint32 header size, JSON header, then the raw arrays,
+# each starting on an ALIGN boundary at the offset recorded in the header.
+# A mesh has its 'arrays' and optionally coarser 'lods', lists of arrays
+
+import hashlib
+import json
+import os
+import re
+import struct
+
+import numpy as np
+
+import atomicfile
+
+MAGIC = b'MESHCACHE2\n'
+ALIGN = 16
+CACHE_DIR = os.path.join('.cache', 'meshes')
+
+
+def source_files(file):
+    """ files an import depends on: the model and, for .obj, its .mtl files """
+    files = [file]
+    if file.lower().endswith('.obj'):
+        with open(file, 'rb') as obj:
+            for line in obj:
+                match = re.match(rb'\s*mtllib\s+(.+?)\s*$', line)
+                if match:
+                    files.append(os.path.join(os.path.dirname(file), match.group(1).decode()))
+    return files
+
+
+def cache_key(file, flags, *extra):
+    """ hash of the source contents and import parameters """
+    digest = hashlib.sha1(MAGIC + repr((flags,) + extra).encode())
+    for source in source_files(file):
+        if os.path.exists(source):
+            with open(source, 'rb') as content:
+                digest.update(content.read())
+    return digest.hexdigest()
+
+
+def _json_value(value):
+    """ material property as a JSON value, None if it can't be stored """
+    if isinstance(value, bytes):
+        return value.decode(errors='replace')
+    if isinstance(value, (str, int, float)):
+        return value
+    try:
+        return np.asarray(value, np.float64).tolist()
+    except (TypeError, ValueError):
+        return None
+
+
+def write(path, model):
+    """ store a model {'materials': [dict], 'meshes': [{'material': index,
+        'arrays': {name: ndarray}, 'lods': [{name: ndarray}]}]} atomically
+        at path """
+    header = {'materials': [{key: _json_value(value) for key, value in material.items()
+                             if _json_value(value) is not None} for material in model['materials']],
+              'meshes': []}
+    arrays, offset = [], 0
+
+    def layout(named_arrays):
+        nonlocal offset
+        specs = {}
+        for name, array in named_arrays.items():
+            array = np.ascontiguousarray(array)
+            specs[name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset}
+            arrays.append((offset, array))
+            offset += -(-array.nbytes // ALIGN) * ALIGN
+        return specs
+
+    for mesh in model['meshes']:
+        entry = {key: value for key, value in mesh.items() if key not in ('arrays', 'lods')}
+        entry['arrays'] = layout(mesh['arrays'])
+        entry['lods'] = [layout(lod) for lod in mesh.get('lods', ())]
+        header['meshes'].append(entry)
+
+    # array offsets are relative to the data start, aligned after the header
+    blob = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 4 + len(blob)) // ALIGN) * ALIGN
+    with atomicfile.replace(path) as out:
+        out.write(MAGIC + struct.pack('<I', len(blob)) + blob)
+        for start, array in arrays:
+            out.seek(data_start + start)
+            out.write(array.tobytes())
+        out.truncate(data_start + offset)
+
+
+def read(path):
+    """ model stored by write(), its arrays memory mapped read only """
+    with open(path, 'rb') as cache:
+        if cache.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a mesh cache file: ' + path)
+        size, = struct.unpack('<I', cache.read(4))
+        header = json.loads(cache.read(size))
+    data_start = -(-(len(MAGIC) + 4 + size) // ALIGN) * ALIGN
+
+    def mapped(specs):
+        return {name: np.memmap(path, np.dtype(spec['dtype']), 'r', data_start + spec['offset'],
+                                tuple(spec['shape'])) if np.prod(spec['shape']) else
+                np.zeros(spec['shape'], spec['dtype'])
+                for name, spec in specs.items()}
+
+    for mesh in header['meshes']:
+        mesh['arrays'] = mapped(mesh['arrays'])
+        mesh['lods'] = [mapped(lod) for lod in mesh.get('lods', ())]
+    return header
+
+
+def load(file, flags, importer, *extra):
+    """ model of 'file' from the cache, or from importer() then cached. The
+        entry changes with the source contents, flags and extra parameters """
+    path = os.path.join(CACHE_DIR, cache_key(file, flags, *extra) + '.mesh')
+    if os.path.exists(path):
+        try:
+            return read(path)
+        except (ValueError, OSError, KeyError) as exception:
+            print('WARNING: ignoring broken mesh cache', path, exception)
+    model = importer()
+    if model['meshes']:
+        try:
+            write(path, model)
+            return read(path)
+        except OSError as exception:
+            print('WARNING: unable to write mesh cache', path, exception)
+    return model
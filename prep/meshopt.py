@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# import time mesh optimization: shared vertices, post-transform vertex cache
+# friendly triangle order (Tipsify), then vertices in the order they are used
+
+import numpy as np
+
+CACHE_SIZE = 16  # post-transform vertex cache entries assumed when reordering
+ATTRIBUTES = ('vertices', 'normals', 'tex_coords')
+# meshes optimized so far, their triangles and triangle weighted ACMR sums
+stats = {'meshes': 0, 'triangles': 0, 'before': 0.0, 'after': 0.0}
+
+
+def deduplicate(arrays):
+    """ merge the vertices having all attributes equal, remapping the faces """
+    names = [name for name in ATTRIBUTES if arrays.get(name) is not None]
+    columns = np.hstack([np.asarray(arrays[name], np.float32).reshape(len(arrays['vertices']), -1)
+                         for name in names])
+    if not len(columns):
+        return dict(arrays)
+    rows = np.ascontiguousarray(columns).view(np.dtype((np.void, columns.dtype.itemsize * columns.shape[1])))
+    _, first, remap = np.unique(rows.ravel(), return_index=True, return_inverse=True)
+    result = {name: np.asarray(arrays[name])[first] for name in names}
+    result['faces'] = remap.ravel()[np.asarray(arrays['faces']).reshape(-1, 3)].astype(np.uint32)
+    return result
+
+
+def acmr(faces, cache_size=CACHE_SIZE):
+    """ average cache miss ratio: vertices transformed per triangle with a
+        FIFO post-transform cache, 3 at worst and 0.5 at best """
+    faces = np.asarray(faces).reshape(-1, 3)
+    if not len(faces):
+        return 0.0
+    timestamps, misses = {}, 0
+    for index in faces.ravel().tolist():
+        if misses - timestamps.get(index, -cache_size - 1) > cache_size:
+            timestamps[index] = misses
+            misses += 1
+    return misses / len(faces)
+
+
+def tipsify(faces, nb_vertices, cache_size=CACHE_SIZE):
+    """ triangle order for the post-transform vertex cache, from Sander et
+        al. 2007 "Fast triangle reordering for vertex locality and reduced
+        overdraw": triangles are emitted in fans around a vertex, the next
+        fanning vertex being one of the last used that will stay in cache """
+    faces = np.asarray(faces).reshape(-1, 3)
+    corners = faces.ravel()
+    order = np.argsort(corners, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(corners, minlength=nb_vertices))]).tolist()
+    adjacent = (order // 3).tolist()   # triangles around each vertex, in CSR
+    triangles = faces.tolist()
+    live = np.bincount(corners, minlength=nb_vertices).tolist()
+    cache_time = [0] * nb_vertices
+    emitted = [False] * len(triangles)
+    dead_end, output = [], []
+    time, cursor, fan = cache_size + 1, 0, 0
+
+    while fan >= 0:
+        candidates = []
+        for triangle in adjacent[offsets[fan]:offsets[fan + 1]]:
+            if not emitted[triangle]:
+                emitted[triangle] = True
+                output.append(triangle)
+                for vertex in triangles[triangle]:
+                    dead_end.append(vertex)
+                    candidates.append(vertex)
+                    live[vertex] -= 1
+                    if time - cache_time[vertex] > cache_size:
+                        cache_time[vertex] = time
+                        time += 1
+
+        # next fan: the candidate still in cache after its fan, oldest first
+        fan, best = -1, -1
+        for vertex in candidates:
+            if live[vertex] > 0:
+                priority = time - cache_time[vertex] if time - cache_time[vertex] + 2 * live[vertex] <= cache_size else 0
+                if priority > best:
+                    fan, best = vertex, priority
+        if fan == -1:  # dead end: most recent vertex with triangles left
+            while dead_end and fan == -1:
+                vertex = dead_end.pop()
+                if live[vertex] > 0:
+                    fan = vertex
+            while fan == -1 and cursor < nb_vertices:
+                if live[cursor] > 0:
+                    fan = cursor
+                cursor += 1
+    return faces[np.array(output, np.int64)]
+
+
+def reorder_vertices(arrays):
+    """ vertices renumbered in their order of first use by the faces, so that
+        vertex fetches walk the buffers forward. Unused vertices are dropped """
+    faces = np.asarray(arrays['faces']).reshape(-1, 3)
+    used, first = np.unique(faces.ravel(), return_index=True)
+    order = used[np.argsort(first)]
+    remap = np.zeros(len(arrays['vertices']), np.uint32)
+    remap[order] = np.arange(len(order), dtype=np.uint32)
+    result = {name: np.asarray(arrays[name])[order] for name in ATTRIBUTES if arrays.get(name) is not None}
+    result['faces'] = remap[faces]
+    return result
+
+
+def optimize(arrays, cache_size=CACHE_SIZE, count=True):
+    """ optimized copy of mesh arrays, with a report of the gains:
+        (arrays, {'acmr': (before, after), 'vertices': (before, after)}).
+        Counted in the stats if count """
+    if not len(np.asarray(arrays['faces'])):
+        return arrays, {'acmr': (0.0, 0.0), 'vertices': (len(arrays['vertices']),) * 2}
+    result = deduplicate(arrays)
+    result['faces'] = tipsify(result['faces'], len(result['vertices']), cache_size)
+    result = reorder_vertices(result)
+    report = {'acmr': (acmr(arrays['faces'], cache_size), acmr(result['faces'], cache_size)),
+              'vertices': (len(arrays['vertices']), len(result['vertices']))}
+    if count:
+        triangles = len(np.asarray(result['faces']).reshape(-1, 3))
+        stats['meshes'] += 1
+        stats['triangles'] += triangles
+        stats['before'] += report['acmr'][0] * triangles
+        stats['after'] += report['acmr'][1] * triangles
+    return result, report
+
+
+def acmr_report():
+    """ vertex cache efficiency of the meshes optimized since start """
+    if not stats['triangles']:
+        return 'Vertex cache: no mesh optimized this run, all read from the mesh cache'
+    return 'Vertex cache: ACMR %.2f -> %.2f over %d triangles of %d imported meshes' % (
+        stats['before'] / stats['triangles'], stats['after'] / stats['triangles'],
+        stats['triangles'], stats['meshes'])
@@ -4,6 +4,7 @@ import OpenGL.GL as GL
 import transform as t
 import gpu
 import sh_var_lst as svl
+from glstate import gl
 
 
 # ------------  Scene object classes ------------------------------------------
@@ -11,17 +12,63 @@ class Node:
     """ Scene graph transform and parameter broadcast node """
 
     def __init__(self, children=(), transform=t.identity()):
+        self.observer = None       # called with (node, structure) on changes
+        self._world = None         # cached world matrix, None when dirty
+        self._parent_world = None  # parent world matrix it was computed from
         self.transform = transform
         self.children = list(iter(children))
 
+    @property
+    def transform(self):
+        """ local transform, assigning a new matrix marks the node dirty """
+        return self._transform
+
+    @transform.setter
+    def transform(self, transform):
+        self._transform = transform
+        self.invalidate()
+
+    def invalidate(self):
+        """ mark dirty after modifying the transform matrix in place """
+        self._world = None
+        if self.observer is not None:
+            self.observer(self, False)
+
+    def world(self, model):
+        """ World matrix under parent world matrix 'model', cached until our
+            transform changes or the parent hands down a different matrix
+            object (parents reuse the same object while they are unchanged) """
+        if self._world is None or model is not self._parent_world:
+            self._world = model @ self._transform
+            self._parent_world = model
+        return self._world
+
     def add(self, *drawables):
         """ Add drawables to this node, simply updating children list """
         self.children.extend(drawables)
+        if self.observer is not None:
+            self.observer(self, True)
+
+    def animate(self, **param):
+        """ Per frame hook run before drawing, e.g. to interpolate transform """
+
+    def draw(self, projection, view, model, **param):
+        """ Recursive draw, passing down updated model matrix and the frame
+            parameters (time, alpha) sampled once per frame. """
+        self.animate(**param)
+        world = self.world(model)
+        for child in self.children:
+            child.draw(projection, view, world, **param)
+
+    def simulate(self, time, delta_time):
+        """ Advance this node's own simulated state by a fixed time step """
 
-    def draw(self, projection, view, model):
-        """ Recursive draw, passing down updated model matrix. """
+    def update(self, time, delta_time):
+        """ Advance simulated state of the subtree by a fixed time step """
+        self.simulate(time, delta_time)
         for child in self.children:
-            child.draw(projection, view, model @ self.transform)
+            if hasattr(child, 'update'):
+                child.update(time, delta_time)
 
     def key_handler(self, key):
         """ Dispatch keyboard events to children """
@@ -33,19 +80,46 @@ class Node:
 # -------------- Phong rendered Mesh class -----------------------------------
 # mesh to refactor all previous classes
 class Mesh:
+    render_pass = 'world'  # pass of render.PASSES drawing this mesh
+    instanced = False      # drawn many times per call, needs the instanced depth shader
 
-    def __init__(self, shader, attributes, index=None):
+    def __init__(self, shader, attributes, index=None, vertex_array=None):
         self.shader = shader
         names = [svl.view, svl.projection, svl.model]
         self.loc = {n: GL.glGetUniformLocation(shader.glid, n) for n in names}
-        self.vertex_array = gpu.VertexArray(attributes, index)
+        # an already uploaded vertex array can be given instead of attributes
+        self.vertex_array = vertex_array or gpu.VertexArray(attributes, index)
+        self.bounds = None  # model space (center, radius, (lower, upper)) if culled
+        self.lods = [self]  # meshes of decreasing detail, starting with this one
+
+    def draw(self, projection, view, model, queue=None, **param):
+        """ render now, or push a draw packet if given a render queue """
+        if queue is not None:
+            queue.push(self, model)
+        else:
+            self.render(projection, view, model, **param)
 
-    def draw(self, projection, view, model, primitives=GL.GL_TRIANGLES):
-        GL.glUseProgram(self.shader.glid)
+    def state_ids(self):
+        """ (program, texture, vertex array) GL ids, sorting draw packets """
+        return self.shader.glid, 0, self.vertex_array.glid or 0
 
-        GL.glUniformMatrix4fv(self.loc[svl.view], 1, True, view)
-        GL.glUniformMatrix4fv(self.loc[svl.projection], 1, True, projection)
-        GL.glUniformMatrix4fv(self.loc[svl.model], 1, True, model)
+    def _set_matrices(self, loc, projection, view, model):
+        GL.glUniformMatrix4fv(loc[svl.view], 1, True, view)
+        GL.glUniformMatrix4fv(loc[svl.projection], 1, True, projection)
+        if self.vertex_array.dequantize is not None:  # quantized positions
+            model = model @ self.vertex_array.dequantize
+        GL.glUniformMatrix4fv(loc[svl.model], 1, True, model)
+
+    def render(self, projection, view, model, primitives=GL.GL_TRIANGLES, **param):
+        gl.use_program(self.shader.glid)
+        self._set_matrices(self.loc, projection, view, model)
 
         # draw triangle as GL_TRIANGLE vertex array, draw array call
         self.vertex_array.execute(primitives)
+
+    def render_depth(self, projection, view, model, shader, primitives=GL.GL_TRIANGLES):
+        """ depth only render for a pre-pass, with a position only shader
+            computing the same depth as ours """
+        gl.use_program(shader.glid)
+        self._set_matrices(shader.locations(svl.view, svl.projection, svl.model), projection, view, model)
+        self.vertex_array.execute(primitives)
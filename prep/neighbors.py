@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# uniform grid neighbour search, for boids, predators avoidance or culling
+
+import numpy as np
+
+# large primes spreading integer cell coordinates over the hash table
+_PRIMES = np.array((73856093, 19349663, 83492791), np.int64)
+MAX_TABLE_BITS = 16  # bucket ids fit 16 bits, see SpatialGrid.build
+
+
+class SpatialGrid:
+    """ Spatial hash of 3D points on a uniform grid. Cell ids are counting
+        sorted so that the points of each cell are contiguous in 'order' """
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.points = np.zeros((0, 3), np.float32)
+        self.order = np.zeros(0, np.int32)   # point indices grouped by cell
+        self.start = np.zeros(1, np.int64)   # first slot of each hash bucket
+        self.count = np.zeros(1, np.int64)   # number of points per bucket
+
+    def _hash(self, cells):
+        """ bucket of integer cell coordinates, in [0, table size) """
+        mixed = np.bitwise_xor.reduce(cells * _PRIMES, axis=-1)
+        return mixed & (len(self.count) - 1)
+
+    def build(self, points):
+        """ index (N, 3) points, rebuilding the whole grid """
+        self.points = np.asarray(points, np.float32)
+        table_size = 1 << min(max(int(2 * len(self.points)).bit_length(), 4), MAX_TABLE_BITS)
+        self.count = np.zeros(table_size, np.int64)  # sets the hash table size
+        ids = self._hash(np.floor(self.points / self.cell_size).astype(np.int64)).astype(np.uint16)
+
+        # counting sort: bucket sizes and their prefix sum, then placement of
+        # each point after the points of its bucket before it. numpy's stable
+        # sort of 16 bit keys is such a radix sort, linear in the points
+        self.count = np.bincount(ids, minlength=table_size)
+        self.start = np.cumsum(self.count) - self.count
+        self.order = np.argsort(ids, kind='stable').astype(np.int32)
+        return self
+
+    def query(self, points, radius):
+        """ all indexed points within 'radius' of each of the (Q, 3) query
+            points, as CSR arrays: neighbours of query q are
+            indices[indptr[q]:indptr[q+1]] """
+        points = np.asarray(points, np.float32).reshape(-1, 3)
+        reach = int(np.ceil(radius / self.cell_size))
+        steps = np.arange(-reach, reach + 1)
+        offsets = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), -1).reshape(-1, 3)
+
+        # buckets covering each query's neighbourhood, each counted once even
+        # when hash collisions send several cells to the same bucket
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        buckets = np.sort(self._hash(cells[:, np.newaxis, :] + offsets), axis=1)
+        counts = self.count[buckets]
+        counts[:, 1:][buckets[:, 1:] == buckets[:, :-1]] = 0
+
+        # expand every (query, bucket) pair into its candidate points
+        counts, starts = counts.ravel(), self.start[buckets].ravel()
+        first = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        candidates = self.order[first + np.arange(len(first))]
+        queries = np.repeat(np.arange(len(counts), dtype=np.int32) // len(offsets), counts)
+
+        delta = self.points[candidates] - points[queries]
+        keep = np.einsum('ij,ij->i', delta, delta) <= radius * radius
+        queries, indices = queries[keep], candidates[keep]
+
+        indptr = np.zeros(len(points) + 1, np.int64)
+        np.cumsum(np.bincount(queries, minlength=len(points)), out=indptr[1:])
+        return indptr, indices
+
+
+def csr_rows(indptr):
+    """ row index of each entry of a CSR index array """
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+
+def segment_sum(rows, values, nb_rows):
+    """ per row sums of (K, D) values whose rows are given, as (nb_rows, D) """
+    values = np.asarray(values).reshape(len(rows), -1)
+    return np.stack([np.bincount(rows, values[:, i], nb_rows) for i in range(values.shape[1])], -1)
@@ -5,9 +5,9 @@ import numpy as np
 
 from anim import ProceduralAnim
 from model import Node
-from anim import ObjectKeyFrameControlNode
+from occlusion import OcclusionNode
+from anim import ObjectKeyFrameControlNode, TransformTracks
 
-import glfw
 
 
 def get_skybox_node(skybox_shader):
@@ -22,16 +22,16 @@ def get_scr_node(screen_shader, width, height):
     return screen_shape
 
 
-def sin_motion():
-    trans_mat = t.translate(0, np.sin(glfw.get_time()), 0)
+def sin_motion(time):
+    trans_mat = t.translate(0, np.sin(time), 0)
     keyframe_transform = trans_mat
     return keyframe_transform
 
 
-def fig8_motion():
+def fig8_motion(time):
     r = 50
     speed = 100
-    angle = (glfw.get_time() * speed) % 360
+    angle = (time * speed) % 360
     x = r * np.cos(np.deg2rad(angle))
     y = r/20 * (np.cos(np.deg2rad(angle)) + np.sin(np.deg2rad(angle)))
     z = r * np.sin(np.deg2rad(angle))
@@ -41,10 +41,10 @@ def fig8_motion():
     return keyframe_transform
 
 
-def circ_motion():
+def circ_motion(time):
     r = 5
     speed = 5
-    angle = (glfw.get_time() * speed) % 360
+    angle = (time * speed) % 360
     x = r * np.cos(np.deg2rad(angle))
     y = r/2 * np.sin(np.deg2rad(angle))
     z = r * np.sin(np.deg2rad(angle))
@@ -53,10 +53,10 @@ def circ_motion():
     return keyframe_transform
 
 
-def circA_motion():
+def circA_motion(time):
     r = 5
     speed = 5
-    angle = (glfw.get_time() * speed) % 360
+    angle = (time * speed) % 360
     angle = 180 + angle
     x = r * np.cos(np.deg2rad(angle))
     y = r/2 * np.sin(np.deg2rad(angle))
@@ -66,17 +66,19 @@ def circA_motion():
     return keyframe_transform
 
 
-def get_world_node(world_shader):
+def get_world_node(world_shader, instanced_shader=None, scheduler=None):
     #     fish_lst = ['ReefFish12', 'TinyYellowFish', 'YellowTang', 'Barracuda', 'ReefFish17',
     #                 'ReefFish14', 'BlueStarfish', 'BottlenoseDolphin', 'GiantGrouper', 'ClownFish2',
     #                 'ReefFish16', 'ReefFish8', 'NurseShark', 'ReefFish20', 'SeaHorse',
     #                 'LionFish', 'WhaleShark', 'ReefFish7', 'ReefFish3', 'BlueTang',
     #                 'ReefFish5', 'ReefFish0', 'ReefFish4', 'SeaSnake']
     scale = 0.5
+    # with an instanced shader each flock is drawn in one call per mesh
+    boid_shader, get_boid = (instanced_shader, b.get_instanced_boid) if instanced_shader else (world_shader, b.get_boid)
     # axis_shape = Node(transform=t.translate(0.0, 0.0, 0.0) @ t.scale(0.1))
     # axis_shape.add(o.Axis(world_shader))
 
-    starfish_boid_shape = b.get_boid(world_shader, 'BlueStarfish', 5,
+    starfish_boid_shape = get_boid(boid_shader, 'BlueStarfish', 5,
                                      np.array([-10.0, -10.0, -10.0]), np.array([10.0, -10.0, 10.0]))
 
     seahorse_shape = Node(transform=t.translate(-12.5, 1.0, -1.0) @ t.scale(scale * 2))
@@ -84,17 +86,18 @@ def get_world_node(world_shader):
     seahorse_animnode = ProceduralAnim(sin_motion)
     seahorse_animnode.add(seahorse_shape)
 
-    clownfish_boid_shape = b.get_boid(world_shader, 'ClownFish2', 25, np.array([-4, -2, -10]), np.array([4, 2, -12]),
-                                      rot_axis=(0, 1, 0), rot_angle=-90)
+    clownfish_boid_shape = get_boid(boid_shader, 'ClownFish2', 25, np.array([-4, -2, -10]), np.array([4, 2, -12]),
+                                      rot_axis=(0, 1, 0), rot_angle=-90, rules=b.FISH_RULES, scheduler=scheduler)
     gaintgrouper_shape = Node(transform=t.translate(8, 0, -9) @ t.rotate((0, 1, 0), -100) @ t.scale(scale*2))
     gaintgrouper_shape.add(o.Fish(world_shader, 'GiantGrouper'))
     clownfish_boid_animnode = ProceduralAnim(fig8_motion)
-    clownfish_boid_animnode.add(*clownfish_boid_shape, gaintgrouper_shape)
+    clownfish_boid_animnode.add(OcclusionNode(clownfish_boid_shape), gaintgrouper_shape)
 
-    reeffish_boid_shape = b.get_boid(world_shader, 'reeffish14', 50, np.array([-20, -5, -2]), np.array([20, 5, 2]),
-                                     rot_axis=(0, 1, 0), rot_angle=90, scale=scale*0.25)
+    reeffish_boid_shape = get_boid(boid_shader, 'reeffish14', 50, np.array([-20, -5, -2]), np.array([20, 5, 2]),
+                                     rot_axis=(0, 1, 0), rot_angle=90, scale=scale*0.25,
+                                     rules=b.FISH_RULES, scheduler=scheduler)
     reeffish_boid_animnode = ProceduralAnim(circ_motion)
-    reeffish_boid_animnode.add(*reeffish_boid_shape)
+    reeffish_boid_animnode.add(OcclusionNode(reeffish_boid_shape))
 
     whaleshark_pos = (50, 5, -100)
     whaleshark_shape = Node(transform=t.translate(whaleshark_pos) @ t.rotate((0, 1, 0), -20) @ t.scale(scale * 2))
@@ -105,9 +108,6 @@ def get_world_node(world_shader):
     whaleshark_scale_keys = {0: 1,
                              15: 1,
                              16: 0.1}
-    whaleshark_keynode = ObjectKeyFrameControlNode(whaleshark_translate_keys, whaleshark_rotate_keys,
-                                                   whaleshark_scale_keys)
-    whaleshark_keynode.add(whaleshark_shape)
 
     lionfish_shape = Node(transform=t.translate(15, 1.0, -1.0)  @ t.rotate((0, 1, 0), 180) @ t.scale(scale))
     lionfish_shape.add(o.Fish(world_shader, 'lionfish'))
@@ -118,19 +118,28 @@ def get_world_node(world_shader):
     lionfish_scale_keys = {0: 1,
                            9: 1,
                            10: 0.001}
-    lionfish_keynode = ObjectKeyFrameControlNode(lionfish_translate_keys, lionfish_rotate_keys, lionfish_scale_keys)
+
+    # both fish are keyframed by the same tracks, evaluated together
+    fish_tracks = TransformTracks([(whaleshark_translate_keys, whaleshark_rotate_keys, whaleshark_scale_keys),
+                                   (lionfish_translate_keys, lionfish_rotate_keys, lionfish_scale_keys)])
+    whaleshark_keynode = ObjectKeyFrameControlNode(tracks=fish_tracks, track=0)
+    whaleshark_keynode.add(whaleshark_shape)
+    lionfish_keynode = ObjectKeyFrameControlNode(tracks=fish_tracks, track=1)
     lionfish_keynode.add(lionfish_shape)
     lionfish_animnode = ProceduralAnim(sin_motion)
     lionfish_animnode.add(lionfish_keynode)
 
-    reeffishA_boid_shape = b.get_boid(world_shader, 'reeffish7', 50, np.array([-20, -5, -2]), np.array([20, 5, 2]),
-                                      rot_axis=(0, 1, 0), rot_angle=90, scale=scale*0.25)
+    reeffishA_boid_shape = get_boid(boid_shader, 'reeffish7', 50, np.array([-20, -5, -2]), np.array([20, 5, 2]),
+                                      rot_axis=(0, 1, 0), rot_angle=90, scale=scale*0.25,
+                                      rules=b.FISH_RULES, scheduler=scheduler)
     reeffishA_boid_animnode = ProceduralAnim(circA_motion)
-    reeffishA_boid_animnode.add(*reeffishA_boid_shape)
+    reeffishA_boid_animnode.add(OcclusionNode(reeffishA_boid_shape))
 
     world_shape = Node()
     # world_shape.add(axis_shape, *starfish_boid_shape, lionfish_animnode, whaleshark_keynode, seahorse_animnode,
     #                 clownfish_boid_animnode, reeffish_boid_animnode, reeffishA_boid_animnode)
-    world_shape.add(*starfish_boid_shape, lionfish_animnode, whaleshark_keynode, seahorse_animnode,
-                    clownfish_boid_animnode, reeffish_boid_animnode, reeffishA_boid_animnode)
+    # the large fish are plain occluders, drawn before the occlusion nodes.
+    # Each flock is skipped while its box is hidden behind them
+    world_shape.add(lionfish_animnode, whaleshark_keynode, seahorse_animnode, clownfish_boid_animnode,
+                    OcclusionNode(starfish_boid_shape), reeffish_boid_animnode, reeffishA_boid_animnode)
     return world_shape
@@ -2,9 +2,15 @@
 
 import os
 
+import numpy as np
+
+import fileindex
 import loaders as ld
+import lod
+import transform as t
 
 from model import Node
+from material import InstancedPhongMesh
 
 
 class Suzy(Node):
@@ -13,18 +19,99 @@ class Suzy(Node):
         self.add(*[mesh for mesh in ld.load_model('suzzane.obj', shader, light_dir)])
 
 
+def find_fish(name):
+    """ path of the .obj model of fish species 'name' """
+    index = fileindex.index()
+    for obj_dir in index.find_dir(name, './Fish'):
+        for file in index.files(obj_dir):
+            if os.path.basename(file).split('.')[1] == 'obj':
+                return file
+    raise Exception('Fish ' + name + ' not found')
+
+
 class Fish(Node):
+    """ Fish of a species, its meshes drawn at the level of detail matching
+        its size on screen """
     def __init__(self, shader, name, dlight_dir=(0, -1, 0)):
         super().__init__()
-        for root, dirs, files in os.walk('./Fish'):
-            for obj_dir in dirs:
-                if obj_dir.lower() == name.lower():
-                    for root, dirs, files in os.walk(os.path.join(root, obj_dir)):
-                        for file in files:
-                            if str(file).split('.')[1] == 'obj':
-                                self.add(*[mesh for mesh in ld.load_model(os.path.join(root, file), shader, dlight_dir)])
-                                return
-        raise Exception('Fish ' + name + ' not found')
+        self.shader, self.released = shader, False
+        self.bounds = None  # (center, radius) sphere around all the meshes
+        self.lod = None     # current level of detail, kept for hysteresis
+        # with a background loading pipeline the fish appears once loaded
+        self.asset_key, _ = ld.acquire_model(find_fish(name), shader, dlight_dir, callback=self.loaded)
+
+    def loaded(self, meshes):
+        """ shared meshes of the species are available, on the main thread.
+            None if they failed to load: nothing to give back then """
+        if meshes is None:
+            self.asset_key = None
+        elif not self.released:
+            spheres = [mesh.bounds for mesh in meshes if mesh.bounds is not None]
+            self.bounds = lod.merge_spheres(spheres) if spheres else None
+            self.add(*meshes)
+
+    def draw(self, projection, view, model, **param):
+        self.animate(**param)
+        world = self.world(model)
+        level = 0
+        if self.bounds is not None:
+            sizes = lod.projected_sizes(projection, view, *t.transform_spheres(world, *self.bounds))
+            self.lod = lod.select_levels(sizes, self.lod)
+            level = int(self.lod[0])
+        for mesh in self.children:
+            mesh.lods[min(level, len(mesh.lods) - 1)].draw(projection, view, world, **param)
+
+    def release(self):
+        """ Give back the shared meshes, freed once no other fish uses them """
+        if not self.released:
+            ld.registry.release(self.asset_key)
+            self.released = True
+            self.children = []
+            if self.observer is not None:
+                self.observer(self, True)
+
+
+class InstancedFish(Fish):
+    """ Whole school of one species, its fish split in buckets by level of
+        detail, each drawn with one instanced draw call per mesh """
+    def __init__(self, shader, name, matrices=(), dlight_dir=(0, -1, 0)):
+        self.buckets = []   # per mesh, an instanced mesh per level of detail
+        self.set_instances(matrices)
+        super().__init__(shader, name, dlight_dir)
+
+    def loaded(self, meshes):
+        if meshes is not None and not self.released:
+            self.buckets = [[InstancedPhongMesh(self.shader, level) for level in mesh.lods] for mesh in meshes]
+            self.moved = True
+        super().loaded(None if meshes is None else [instanced for bucket in self.buckets for instanced in bucket])
+
+    def set_instances(self, matrices):
+        """ (N, 4, 4) model matrices of the fish, relative to this node """
+        self.matrices = np.asarray(matrices, np.float32).reshape(-1, 4, 4)
+        self.moved = True  # buckets must be filled again
+
+    def release(self):
+        self.buckets = []
+        super().release()
+
+    def draw(self, projection, view, model, **param):
+        self.animate(**param)
+        world = self.world(model)
+        levels = np.zeros(len(self.matrices), np.int64)
+        if self.bounds is not None:
+            spheres = t.transform_spheres(world @ self.matrices, *self.bounds)
+            levels = lod.select_levels(lod.projected_sizes(projection, view, *spheres), self.lod)
+        if self.moved or not np.array_equal(levels, self.lod):
+            for bucket in self.buckets:
+                bucket_levels = np.minimum(levels, len(bucket) - 1)
+                for level, mesh in enumerate(bucket):
+                    mesh.set_instances(self.matrices[bucket_levels == level])
+            self.moved = False
+        self.lod = levels
+        for bucket in self.buckets:
+            for mesh in bucket:
+                if len(mesh.matrices):
+                    mesh.draw(projection, view, world, **param)
 
 
 class Axis(Node):
@@ -36,10 +123,7 @@ class Axis(Node):
 class Skybox(Node):
     def __init__(self, shader):
         super().__init__()
-        skybox_files = []
-        for root, dirs, files in os.walk('./skybox'):
-            for file in files:
-                skybox_files.append(str(os.path.join(root, file)))
+        skybox_files = fileindex.index().files('./skybox')
         self.add(ld.load_cubemap(skybox_files, shader))
         return
 
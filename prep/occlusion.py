@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# hardware occlusion culling: box proxies around the meshes of occlusion
+# nodes are tested against the depth of the drawn frame, and their results
+# gate the next frame's draws, so that the GPU is never waited for
+
+from functools import partial
+
+import OpenGL.GL as GL
+import numpy as np
+
+import sh_var_lst as svl
+import transform as t
+from glstate import gl
+from gpu import VertexArray
+from model import Node
+from resources import resources
+
+# unit cube, the proxy of a box being the cube scaled and moved onto it
+CUBE_VERTICES = np.array([(x, y, z) for x in (0, 1) for y in (0, 1) for z in (0, 1)], np.float32)
+CUBE_FACES = np.array(((0, 1, 3), (0, 3, 2), (4, 5, 7), (4, 7, 6), (0, 1, 5), (0, 5, 4),
+                       (2, 3, 7), (2, 7, 6), (0, 2, 6), (0, 6, 4), (1, 3, 7), (1, 7, 5)), np.uint16)
+MIN_EXTENT = 1e-3  # flat boxes still cover pixels
+
+
+def delete_queries(glids):
+    GL.glDeleteQueries(len(glids), glids)
+
+
+def packets_box(packets):
+    """ world space (lower, upper) box around the (mesh, world) packets,
+        None if there are none or one of the meshes has no bounds """
+    lowers, uppers = [], []
+    for mesh, world in packets:
+        if mesh.bounds is None:
+            return None
+        # instanced meshes: one box per instance
+        matrices = world @ mesh.matrices if hasattr(mesh, 'matrices') else np.asarray(world)[np.newaxis]
+        if not len(matrices):
+            continue
+        corners = np.array(np.meshgrid(*zip(*mesh.bounds[2]), indexing='ij')).reshape(3, -1).T
+        corners = np.einsum('nij,kj->nki', matrices[:, :3, :3], corners) + matrices[:, np.newaxis, :3, 3]
+        lowers.append(corners.reshape(-1, 3).min(axis=0))
+        uppers.append(corners.reshape(-1, 3).max(axis=0))
+    if not lowers:
+        return None
+    return np.min(lowers, axis=0), np.max(uppers, axis=0)
+
+
+class OcclusionQuery:
+    """ Two GL_ANY_SAMPLES_PASSED queries of a proxy, used in turn: the one
+        issued in the last frame is read or gates this frame's draws while
+        the other one is issued """
+
+    def __init__(self):
+        self.glids = [int(glid) for glid in GL.glGenQueries(2)]
+        self.issued = [False, False]  # query holds the result of its last issue
+        self.next = 0                 # query issued this frame
+        self.resource = resources.track(self, 'query', partial(delete_queries, list(self.glids)))
+
+    def condition(self):
+        """ last frame's query, to gate draws with, None if not issued """
+        return self.glids[1 - self.next] if self.issued[1 - self.next] else None
+
+    def visible(self):
+        """ last frame's result, None if not issued or not available yet """
+        glid = self.condition()
+        if glid is None or not GL.glGetQueryObjectuiv(glid, GL.GL_QUERY_RESULT_AVAILABLE):
+            return None
+        return bool(GL.glGetQueryObjectuiv(glid, GL.GL_QUERY_RESULT))
+
+    def begin(self):
+        GL.glBeginQuery(GL.GL_ANY_SAMPLES_PASSED, self.glids[self.next])
+
+    def end(self):
+        GL.glEndQuery(GL.GL_ANY_SAMPLES_PASSED)
+        self.issued[self.next] = True
+        self.next = 1 - self.next
+
+    def skip(self):
+        """ no query this frame, the next one draws unconditionally """
+        self.issued[self.next] = False
+        self.next = 1 - self.next
+
+
+class OcclusionCuller:
+    """ Occlusion culling of a frame for render.RenderPasses. Occlusion
+        nodes hand over the packets of their subtree with their query: the
+        packets of nodes found hidden last frame are dropped, the others are
+        drawn gated by the query while its result is not known. Once the
+        passes are drawn, the box proxies of the nodes issue new queries """
+
+    def __init__(self, shader, near=0.1):
+        self.shader = shader  # position only shader, see depth.vert
+        self.near = near      # proxies closer than this can't be tested
+        self.cube = VertexArray([CUBE_VERTICES], CUBE_FACES)
+        self.enabled = True
+        self.pending = []                # (query, lower, upper) to issue
+        self.occluded = [0, 0]           # nodes, packets dropped this frame
+        self.last_frame = (0, 0, 0)      # (queries, occluded nodes, occluded packets)
+
+    def submit(self, passes, query, packets):
+        """ push the packets of a node to passes, unless found hidden """
+        box = packets_box(packets)
+        visible = query.visible() if box is not None else True
+        if visible is False:
+            self.occluded[0] += 1
+            self.occluded[1] += len(packets)
+        else:
+            condition = query.condition() if visible is None else None
+            for mesh, world in packets:
+                passes.push(mesh, world, condition, occludee=True)
+        if box is None:
+            query.skip()
+        else:
+            self.pending.append((query,) + box)
+
+    def issue(self, projection, view, planes=None):
+        """ draw the proxies of this frame's nodes in their queries, against
+            the depth buffer of the drawn frame, without touching it """
+        pending, self.pending = self.pending, []
+        issued = 0
+        if pending:
+            eye = np.linalg.inv(view)[:3, 3]
+            depth_mask = gl.current.get('depth_mask', True)
+            gl.use_program(self.shader.glid)
+            gl.color_mask(False)
+            gl.depth_mask(False)
+            gl.depth_func(GL.GL_LESS)
+            gl.disable(GL.GL_CULL_FACE)  # seen from any side
+            loc = self.shader.locations(svl.view, svl.projection, svl.model)
+            GL.glUniformMatrix4fv(loc[svl.view], 1, True, view)
+            GL.glUniformMatrix4fv(loc[svl.projection], 1, True, projection)
+            for query, lower, upper in pending:
+                # eye in the box: its near faces are clipped, visible anyway
+                inside = np.all(eye > lower - self.near) and np.all(eye < upper + self.near)
+                center, radius = (lower + upper) / 2, float(np.linalg.norm(upper - lower)) / 2
+                if inside or (planes is not None and not t.spheres_in_frustum(planes, center, radius)[0]):
+                    query.skip()
+                    continue
+                model = t.translate(lower) @ t.scale(np.maximum(upper - lower, MIN_EXTENT))
+                GL.glUniformMatrix4fv(loc[svl.model], 1, True, model)
+                query.begin()
+                self.cube.execute(GL.GL_TRIANGLES)
+                query.end()
+                issued += 1
+            gl.enable(GL.GL_CULL_FACE)
+            gl.depth_mask(depth_mask)
+            gl.color_mask(True)
+        self.last_frame = (issued,) + tuple(self.occluded)
+        self.occluded = [0, 0]
+        return self.last_frame
+
+
+class PacketList:
+    """ render queue stand-in collecting the (mesh, world) draw packets """
+
+    def __init__(self):
+        self.packets = []
+
+    def push(self, mesh, world):
+        self.packets.append((mesh, world))
+
+
+class OcclusionNode(Node):
+    """ Node whose subtree is skipped while the box around its meshes is
+        hidden behind what is drawn, as found by an occlusion query with one
+        frame of latency. Meant for the many small meshes, flocks or other
+        occludees, behind large plain meshes acting as occluders. Its
+        packets are drawn after theirs, or as a plain Node without occlusion
+        culling """
+
+    def __init__(self, children=(), transform=t.identity()):
+        super().__init__(children, transform)
+        self.query = None  # created when first drawn, with a current context
+
+    def draw(self, projection, view, model, queue=None, **param):
+        if not hasattr(queue, 'occlude'):
+            super().draw(projection, view, model, queue=queue, **param)
+            return
+        self.animate(**param)
+        world = self.world(model)
+        packets = PacketList()
+        for child in self.children:
+            child.draw(projection, view, world, queue=packets, **param)
+        if self.query is None:
+            self.query = OcclusionQuery()
+        queue.occlude(self.query, packets.packets)
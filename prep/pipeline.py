@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# background asset loading, GL uploads drained by the render loop
+
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+UPLOAD_BUDGET = 0.004  # seconds of GL uploads allowed per frame
+
+
+class AssetPipeline:
+    """ Runs the CPU side of asset loading (mesh import, image decoding) in a
+        thread pool while the viewer is already drawing. The GL side of each
+        asset is queued and run on the main thread by drain(), a few per frame """
+
+    def __init__(self, workers=None, budget=UPLOAD_BUDGET):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='assets')
+        self.budget = budget
+        self.pending = deque()  # (future, upload, failed functions), in submit order
+
+    def submit(self, work, upload, failed=None):
+        """ work() runs in a worker thread, upload(result) later in drain(),
+            or failed() instead if any of them raises """
+        self.pending.append((self.executor.submit(work), upload, failed))
+
+    def busy(self):
+        return bool(self.pending)
+
+    def drain(self, budget=None):
+        """ run the uploads of finished work until the time budget is spent,
+            at least one per call so that loading always progresses """
+        deadline = time.perf_counter() + (self.budget if budget is None else budget)
+        done = 0
+        for _ in range(len(self.pending)):
+            if done and time.perf_counter() > deadline:
+                break
+            future, upload, failed = self.pending.popleft()
+            if not future.done():
+                self.pending.append((future, upload, failed))  # not ready, look again later
+                continue
+            done += 1
+            try:
+                upload(future.result())
+            except Exception as exception:  # report and carry on, like loaders
+                print('ERROR loading asset:', exception)
+                if failed is not None:
+                    failed()
+        return done
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# compact vertex formats, chosen per mesh from the range of its attributes
+
+import OpenGL.GL as GL
+import numpy as np
+
+from gpu import Attribute
+
+stats = {'float': 0, 'packed': 0}  # bytes of the meshes encoded so far
+
+
+def quantize_positions(vertices):
+    """ positions as normalized uint16 over the mesh bounding box, with the
+        uniform scale & translation matrix reading them back in model space.
+        The scale being uniform, it can be folded in the model matrix
+        without changing the normal matrix orientation """
+    vertices = np.asarray(vertices, np.float64).reshape(-1, 3)
+    lower = vertices.min(axis=0)
+    extent = max(float((vertices.max(axis=0) - lower).max()), 1e-12)
+    data = np.round((vertices - lower) / extent * 65535).astype(np.uint16)
+    dequantize = np.identity(4, np.float32)
+    dequantize[:3, :3] *= extent
+    dequantize[:3, 3] = lower
+    return Attribute(data, GL.GL_UNSIGNED_SHORT, 3, True), dequantize
+
+
+def pack_normals(normals):
+    """ unit vectors as signed normalized 10 bits per axis, in one GL_INT_2_10_10_10_REV """
+    normals = np.asarray(normals, np.float64).reshape(-1, 3)
+    lengths = np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    fixed = np.round(np.clip(normals / lengths, -1, 1) * 511).astype(np.int64) & 0x3FF
+    data = (fixed[:, 0] | (fixed[:, 1] << 10) | (fixed[:, 2] << 20)).astype(np.uint32)
+    return Attribute(data, GL.GL_INT_2_10_10_10_REV, 4, True)
+
+
+def pack_tex_coords(tex_coords):
+    """ (u, v) as normalized uint16 when in [0, 1], else as half floats when
+        they fit, else left as floats """
+    uv = np.asarray(tex_coords, np.float32).reshape(len(tex_coords), -1)[:, :2]
+    if len(uv) and uv.min() >= 0 and uv.max() <= 1:
+        return Attribute(np.round(uv * 65535).astype(np.uint16), GL.GL_UNSIGNED_SHORT, 2, True)
+    if not len(uv) or np.abs(uv).max() < 2048:
+        return Attribute(uv.astype(np.float16), GL.GL_HALF_FLOAT, 2)
+    return Attribute(uv)
+
+
+def index_array(faces, nb_vertices):
+    """ indices as uint16 whenever the mesh has few enough vertices """
+    return np.asarray(faces).astype(np.uint16 if nb_vertices <= 1 << 16 else np.uint32)
+
+
+def encode(arrays, count=True):
+    """ packed vertex attributes for shader locations 0-2 (position, normal,
+        texture coordinates), index array and dequantization matrix of mesh
+        arrays, to give to gpu.VertexArray. Counted in the stats if count """
+    positions, dequantize = quantize_positions(arrays['vertices'])
+    attributes = [positions,
+                  pack_normals(arrays['normals']) if arrays.get('normals') is not None else None,
+                  pack_tex_coords(arrays['tex_coords']) if arrays.get('tex_coords') is not None else None]
+    faces = index_array(arrays['faces'], len(positions.data))
+
+    if not count:
+        return attributes, faces, dequantize
+    stats['float'] += sum(np.asarray(arrays[name]).size * 4 for name in ('vertices', 'normals', 'tex_coords', 'faces')
+                          if arrays.get(name) is not None)
+    stats['packed'] += faces.nbytes + sum(-(-attribute.data[0].nbytes // 4) * 4 * len(attribute.data)
+                                          for attribute in attributes if attribute is not None)
+    return attributes, faces, dequantize
+
+
+def memory_report():
+    """ memory of the encoded meshes compared to plain float32 / int32 """
+    saved = 1 - stats['packed'] / stats['float'] if stats['float'] else 0.0
+    return 'Mesh memory: %.1f KB packed instead of %.1f KB (-%d%%)' % (
+        stats['packed'] / 1024, stats['float'] / 1024, round(saved * 100))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# render queue: meshes met during the traversal are drawn later, sorted
+
+import OpenGL.GL as GL
+import numpy as np
+
+import transform as t
+from glstate import gl
+
+PASSES = ('screen', 'skybox', 'world')  # drawn in this order, each to completion
+UNSORTED = ('screen', 'skybox')         # passes keeping their submission order
+PREPASS = ('world',)                    # opaque passes a depth pre-pass can precede
+
+# packed sort key, most significant first: program, texture, depth, vertex array
+PROGRAM_BITS, TEXTURE_BITS, DEPTH_BITS, VERTEX_ARRAY_BITS = 8, 12, 24, 20
+
+
+def _begin(condition):
+    """ draws until _end only happen if the condition query passed samples,
+        not waiting for its result if not available """
+    if condition is not None:
+        GL.glBeginConditionalRender(condition, GL.GL_QUERY_NO_WAIT)
+
+
+def _end(condition):
+    if condition is not None:
+        GL.glEndConditionalRender()
+
+
+class RenderQueue:
+    """ Draw packets of one pass: mesh, world matrix, the GL ids sorting
+        them, the occlusion query gating them if any and whether they are
+        occlusion tested. Flushing sorts the packets by a packed 64 bit key
+        grouping the state changes, front to back inside a group, after
+        the occluders, then renders them """
+
+    def __init__(self, sort=True):
+        self.sort = sort
+        self.meshes, self.worlds, self.ids, self.conditions, self.occludees = [], [], [], [], []
+
+    def push(self, mesh, world, ids, condition=None, occludee=False):
+        self.meshes.append(mesh)
+        self.worlds.append(world)
+        self.ids.append(ids)
+        self.conditions.append(condition)
+        self.occludees.append(occludee)
+
+    def depths(self, view):
+        """ view space distance of each packet's world matrix origin """
+        origins = np.array([world[:3, 3] for world in self.worlds], np.float64).reshape(-1, 3)
+        return -(origins @ np.asarray(view[2, :3], np.float64) + view[2, 3])
+
+    def keys(self, view, far, depths=None):
+        """ uint64 sort key of each packet, its depth being quantized over [0, far] """
+        ids = np.array(self.ids, np.uint64).reshape(-1, 3)
+        depth = self.depths(view) if depths is None else depths
+        depth = np.round(np.clip(depth / far, 0, 1) * ((1 << DEPTH_BITS) - 1)).astype(np.uint64)
+
+        key = np.zeros(len(self.meshes), np.uint64)
+        for value, bits in ((ids[:, 0], PROGRAM_BITS), (ids[:, 1], TEXTURE_BITS),
+                            (depth, DEPTH_BITS), (ids[:, 2], VERTEX_ARRAY_BITS)):
+            key = (key << np.uint64(bits)) | (value & np.uint64((1 << bits) - 1))
+        return key
+
+    def cull(self, planes):
+        """ mask of the packets intersecting the frustum planes. Bounding
+            spheres of all the plain meshes are tested at once, instanced
+            meshes cull their own instances """
+        visible = np.ones(len(self.meshes), bool)
+        bounded = []
+        for index, mesh in enumerate(self.meshes):
+            if hasattr(mesh, 'cull_instances'):
+                visible[index] = mesh.cull_instances(self.worlds[index], planes) > 0
+            elif mesh.bounds is not None:
+                bounded.append(index)
+        if bounded:
+            centers, radii = t.transform_spheres(np.array([self.worlds[i] for i in bounded]),
+                                                 [self.meshes[i].bounds[0] for i in bounded],
+                                                 np.array([self.meshes[i].bounds[1] for i in bounded]))
+            visible[bounded] = t.spheres_in_frustum(planes, centers, radii)
+        return visible
+
+    def flush(self, projection, view, far, planes=None, depth_shaders=None, **param):
+        """ render the queued packets, except those outside the frustum
+            planes if given, then empty the queue. Returns (drawn, culled).
+            With depth_shaders {instanced: Shader}, the packets are first
+            drawn front to back in the depth buffer only, then shaded with
+            GL_EQUAL depth test so that each pixel is shaded once """
+        order = np.arange(len(self.meshes))
+        if planes is not None and len(order):
+            order = order[self.cull(planes)]
+        depths = self.depths(view) if self.sort or depth_shaders is not None else None
+        meshes, worlds, conditions = self.meshes, self.worlds, self.conditions
+
+        if depth_shaders is not None and len(order):
+            depth_mask = gl.current.get('depth_mask', True)
+            gl.color_mask(False)
+            gl.depth_mask(True)
+            gl.depth_func(GL.GL_LESS)
+            GL.glClear(GL.GL_DEPTH_BUFFER_BIT)  # the pass target may keep last frame's
+            for index in order[np.argsort(depths[order], kind='stable')]:
+                _begin(conditions[index])
+                meshes[index].render_depth(projection, view, worlds[index], depth_shaders[meshes[index].instanced])
+                _end(conditions[index])
+            gl.color_mask(True)
+            gl.depth_mask(False)
+            gl.depth_func(GL.GL_EQUAL)
+
+        if self.sort and len(order) > 1:
+            occludees = np.array(self.occludees, bool)
+            order = order[np.lexsort((self.keys(view, far, depths)[order], occludees[order]))]
+        self.meshes, self.worlds, self.ids, self.conditions, self.occludees = [], [], [], [], []
+        for index in order:
+            _begin(conditions[index])
+            meshes[index].render(projection, view, worlds[index], **param)
+            _end(conditions[index])
+
+        if depth_shaders is not None and len(order):
+            gl.depth_mask(depth_mask)
+            gl.depth_func(GL.GL_LESS)
+        return len(order), len(meshes) - len(order)
+
+
+class RenderPasses:
+    """ One queue per render pass, given as 'queue' draw parameter to the
+        scene graph. Meshes push themselves to their render_pass queue, and
+        the passes are flushed in PASSES order whatever the graph order """
+
+    def __init__(self, far=100.0, passes=PASSES, unsorted=UNSORTED, prepass=PREPASS):
+        self.far = far
+        self.queues = {name: RenderQueue(sort=name not in unsorted) for name in passes}
+        self.order = passes
+        self.culling = True
+        self.prepass_passes = prepass
+        self.depth_shaders = None  # {instanced: depth only Shader}, see RenderQueue.flush
+        self.prepass = False       # depth pre-pass before the prepass_passes, if depth_shaders
+        self.occlusion = None      # occlusion.OcclusionCuller of the occlusion nodes
+        self.last_frame = (0, 0)  # (drawn, culled) packets of the last frame
+
+    def push(self, mesh, world, condition=None, occludee=False):
+        self.queues[mesh.render_pass].push(mesh, world, mesh.state_ids(), condition, occludee)
+
+    def occlude(self, query, packets):
+        """ (mesh, world) packets of an occlusion.OcclusionNode subtree with
+            its query, dropped or gated by occlusion culling if enabled """
+        if self.occlusion is not None and self.occlusion.enabled:
+            self.occlusion.submit(self, query, packets)
+            return
+        query.skip()  # its last result gets outdated
+        for mesh, world in packets:
+            self.push(mesh, world, occludee=True)
+
+    def flush(self, projection, view, **param):
+        """ render all the passes, returns the (drawn, culled) packet counts """
+        planes = t.frustum_planes(projection @ view) if self.culling else None
+        depth_shaders = self.depth_shaders if self.prepass else None
+        counts = [self.queues[name].flush(projection, view, self.far, planes,
+                                          depth_shaders if name in self.prepass_passes else None, **param)
+                  for name in self.order]
+        if self.occlusion is not None:  # against the depth of the whole frame
+            self.occlusion.issue(projection, view, planes)
+        self.last_frame = tuple(sum(count) for count in zip(*counts))
+        return self.last_frame
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# owner of the GL objects: GPU memory accounting, budget and deletion
+
+import threading
+import weakref
+
+BUDGET = 512 << 20  # bytes kept on the GPU before evicting unused assets
+
+
+class Resource:
+    """ GL objects of one wrapper: the function deleting them, None while
+        they are not on the GPU, their memory and the last frame using them """
+
+    def __init__(self, kind, owner=None):
+        self.kind = kind
+        self.owner = owner  # weak reference to the wrapper if evictable
+        self.delete, self.nbytes = None, 0
+        self.frame, self.loads = -1, 0
+
+
+class ResourceManager:
+    """ Every GL object is registered here with the function deleting it.
+        A dying wrapper only queues its deletion, run by collect() in the
+        render loop where the context is current, and shutdown() deletes
+        whatever is left. Evictable wrappers, textures and meshes that can
+        reload from the on-disk caches, are evicted least recently used first
+        while over budget, and reload themselves when used again """
+
+    def __init__(self, budget=BUDGET):
+        self.budget = budget
+        self.frame = 0
+        self.live = set()   # resources currently on the GPU
+        self.dead = []      # resources of dead wrappers, to delete
+        self.lock = threading.Lock()
+        self.evicted, self.reloaded = 0, 0
+
+    def track(self, owner, kind, delete=None, nbytes=0, evictable=False):
+        """ new resource of wrapper 'owner', loaded if given its deletion
+            function. Evictable owners have evict() releasing their objects """
+        resource = Resource(kind, weakref.ref(owner) if evictable else None)
+        weakref.finalize(owner, self._died, resource)
+        if delete is not None:
+            self.loaded(resource, delete, nbytes)
+        return resource
+
+    def _died(self, resource):  # any thread, possibly without GL context
+        with self.lock:
+            self.dead.append(resource)
+
+    def loaded(self, resource, delete, nbytes):
+        """ objects of resource created, delete() deleting them """
+        resource.delete, resource.nbytes = delete, nbytes
+        resource.frame = self.frame
+        resource.loads += 1
+        self.reloaded += resource.loads > 1
+        self.live.add(resource)
+
+    def unload(self, resource):
+        """ delete the objects of resource now, if on the GPU """
+        if resource.delete is not None:
+            resource.delete()
+            resource.delete, resource.nbytes = None, 0
+        self.live.discard(resource)
+
+    def resize(self, resource, nbytes):
+        resource.nbytes = nbytes
+
+    def touch(self, resource):
+        """ mark resource as used by the current frame """
+        resource.frame = self.frame
+
+    def used(self):
+        """ bytes of GPU memory of the live resources """
+        return sum(resource.nbytes for resource in self.live)
+
+    def collect(self):
+        """ end of frame: delete the objects of dead wrappers, then evict the
+            least recently used assets not drawn this frame until back under
+            budget """
+        with self.lock:
+            dead, self.dead = self.dead, []
+        for resource in dead:
+            self.unload(resource)
+
+        used = self.used()
+        if used > self.budget:
+            candidates = sorted((resource for resource in self.live
+                                 if resource.owner is not None and resource.frame < self.frame),
+                                key=lambda resource: resource.frame)
+            for resource in candidates:
+                owner = resource.owner()
+                if owner is None:
+                    continue
+                used -= resource.nbytes
+                owner.evict()
+                self.evicted += 1
+                if used <= self.budget:
+                    break
+        self.frame += 1
+
+    def shutdown(self):
+        """ delete all the GL objects, while the context is still current """
+        with self.lock:
+            self.dead = []
+        for resource in list(self.live):
+            owner = resource.owner() if resource.owner is not None else None
+            if owner is not None:
+                owner.evict()
+            else:
+                self.unload(resource)
+
+    def report(self):
+        kinds = {}
+        for resource in self.live:
+            kinds[resource.kind] = kinds.get(resource.kind, 0) + resource.nbytes
+        return 'GPU memory: %.1f MB of %.1f MB budget (%s), %d evictions, %d reloads' % (
+            self.used() / 2 ** 20, self.budget / 2 ** 20,
+            ', '.join('%s %.1f MB' % (kind, size / 2 ** 20) for kind, size in sorted(kinds.items())),
+            self.evicted, self.reloaded)
+
+
+resources = ResourceManager()
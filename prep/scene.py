@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# scene graph compiled to flat arrays, for batched transform propagation
+
+import numpy as np
+
+from model import Node
+
+
+class CompiledScene:
+    """ Flat array form of a Node tree: parent index of each node, (N, 4, 4)
+        float32 local and world transforms and the nodes grouped by depth,
+        so that world matrices are computed one level at a time with batched
+        matrix products. Drawables are drawn in tree order from the arrays """
+
+    def __init__(self, root):
+        self.root = root
+        self.nodes, self.draw_list = [], []   # draw_list: (drawable, node index)
+        self.animated, self.simulated = [], []
+        self.index = {}                      # id(node) -> its indices
+        self.stale, self.dirty = False, set()
+        parents, depths = [], []
+        self._visit(root, -1, 0, parents, depths)
+
+        self.parents = np.array(parents, np.int64)
+        self.depths = np.array(depths, np.int64)
+        self.levels = [np.flatnonzero(self.depths == depth) for depth in range(self.depths.max() + 1)]
+        self.local = np.stack([node.transform for node in self.nodes]).astype(np.float32)
+        self.world = np.empty_like(self.local)
+        self.model = None  # root parent matrix the world matrices derive from
+        # leaves get persistent views on their world matrix, updated in place.
+        # Opaque nodes cache by matrix identity, they need a new one each time
+        self.draw_calls = [(drawable.draw, index, None if isinstance(drawable, Node) else self.world[index])
+                           for drawable, index in self.draw_list]
+
+    def _visit(self, node, parent, depth, parents, depths):
+        index = len(self.nodes)
+        self.nodes.append(node)
+        self.index.setdefault(id(node), []).append(index)
+        parents.append(parent)
+        depths.append(depth)
+        node.observer = self._changed
+        if type(node).animate is not Node.animate:
+            self.animated.append(node)
+        if type(node).simulate is not Node.simulate:
+            self.simulated.append(node)
+        for child in node.children:
+            # nodes with a custom draw are opaque, drawn as a whole
+            if isinstance(child, Node) and type(child).draw is Node.draw:
+                self._visit(child, index, depth + 1, parents, depths)
+            else:
+                self.draw_list.append((child, index))
+                self._collect_simulated(child)
+
+    def _collect_simulated(self, node):
+        """ nodes having simulated state in the subtree of an opaque node,
+            which draws and animates itself but is stepped with the others """
+        if not isinstance(node, Node):
+            return
+        if type(node).simulate is not Node.simulate:
+            self.simulated.append(node)
+        for child in node.children:
+            self._collect_simulated(child)
+
+    def _changed(self, node, structure):
+        """ observer of the compiled nodes: new transform or new children """
+        if structure:
+            self.stale = True
+        else:
+            self.dirty.add(node)
+
+    def release(self):
+        """ detach from the nodes, before compiling the tree again """
+        for node in self.nodes:
+            node.observer = None
+
+    def propagate(self, first_level=0):
+        """ world matrices of every level from first_level down """
+        for depth in range(first_level, len(self.levels)):
+            rows = self.levels[depth]
+            parent_world = self.model if depth == 0 else self.world[self.parents[rows]]
+            self.world[rows] = parent_world @ self.local[rows]
+
+    def update(self, time, delta_time):
+        """ simulation step of the nodes having simulated state """
+        for node in self.simulated:
+            node.simulate(time, delta_time)
+
+    def draw(self, projection, view, model, **param):
+        """ animate, refresh changed transforms, then draw the draw list """
+        for node in self.animated:
+            node.animate(**param)
+
+        first_level = None
+        if model is not self.model:
+            self.model, first_level = model, 0
+        if self.dirty:
+            dirty, self.dirty = self.dirty, set()
+            rows = [index for node in dirty for index in self.index[id(node)]]
+            self.local[rows] = [self.nodes[index].transform for index in rows]
+            level = self.depths[rows].min()
+            first_level = level if first_level is None else min(first_level, level)
+        if first_level is not None:
+            self.propagate(first_level)
+
+        for draw, index, world in self.draw_calls:
+            draw(projection, view, self.world[index] if world is None else world, **param)
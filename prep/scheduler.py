@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# flock simulation stepped by a pool of worker processes
+
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+import boid as b
+from neighbors import SpatialGrid
+
+MAX_STEP = 0.1  # longest simulated step in seconds, after a stall for example
+
+_attached = {}  # shared memory blocks already opened by this worker process
+
+
+def _state(shm, count):
+    """ (2 slots, positions/velocities, count, 3) view on a flock's memory """
+    return np.ndarray((2, 2, count, 3), np.float32, buffer=shm.buf)
+
+
+def _step_partition(name, count, read, lo, hi, rules, lower_limits, upper_limits, delta_time, live=None):
+    """ worker task: advance boids lo:hi from slot 'read' into the other slot.
+        Handles on the memory of flocks no longer in the 'live' names are
+        closed first, those flocks being closed in the main process """
+    for stale in set(_attached) - set(live if live is not None else _attached):
+        _attached.pop(stale).close()
+    if name not in _attached:
+        _attached[name] = SharedMemory(name=name)
+    state = _state(_attached[name], count)
+    positions, velocities = state[read]
+    grid = SpatialGrid(rules['view_radius']).build(positions) if count > b.DENSE_LIMIT else None
+    state[1 - read, 0, lo:hi], state[1 - read, 1, lo:hi] = b.advance(
+        positions, velocities, rules, lower_limits, upper_limits, delta_time, lo, hi, grid)
+
+
+class SharedFlock:
+    """ Flock whose state lives in shared memory, double buffered: the
+        renderer reads the front slot while the workers write the back one """
+
+    def __init__(self, scheduler, flock, partitions=1):
+        self.scheduler = scheduler
+        self.rules, self.lower_limits, self.upper_limits = flock.rules, flock.lower_limits, flock.upper_limits
+        self.count = len(flock)
+        self.shm = SharedMemory(create=True, size=2 * 2 * max(self.count, 1) * 3 * 4)
+        self.state = _state(self.shm, self.count)
+        self.front = 0
+        self.state[self.front] = flock.positions, flock.velocities
+        bounds = np.linspace(0, self.count, max(1, min(partitions, self.count)) + 1).astype(int)
+        self.partitions = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+        self.pending, self.elapsed = [], 0.0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def positions(self):
+        return self.state[self.front, 0]
+
+    @property
+    def velocities(self):
+        return self.state[self.front, 1]
+
+    def step(self, delta_time):
+        """ never blocks: once the running step is complete its result becomes
+            the front slot and the time elapsed since is submitted as the next """
+        self.elapsed += delta_time
+        if self.pending:
+            if not all(job.ready() for job in self.pending):
+                return
+            for job in self.pending:
+                job.get()  # raises the worker's exception, if any
+            self.front = 1 - self.front
+        self.pending = [self.scheduler.submit(_step_partition, self.shm.name, self.count, self.front, lo, hi,
+                                              self.rules, self.lower_limits, self.upper_limits,
+                                              min(self.elapsed, MAX_STEP), self.scheduler.live)
+                        for lo, hi in self.partitions]
+        self.elapsed = 0.0
+
+    def matrices(self, base=None):
+        """ model matrix of every boid of the latest completed step """
+        return b.heading_matrices(self.positions, self.velocities, base)
+
+    def close(self):
+        """ wait for the running step, then release the memory. Workers
+            close their handles on it with their next step of any flock """
+        for job in self.pending:
+            job.wait()
+        self.pending = []
+        self.state = None
+        self.scheduler.forget(self)
+        self.shm.close()
+        self.shm.unlink()
+
+
+class FlockScheduler:
+    """ Pool of worker processes stepping every shared flock of the scene """
+
+    def __init__(self, processes=None):
+        # spawned workers never inherit the parent's OpenGL context
+        self.pool = mp.get_context('spawn').Pool(processes)
+        self.processes = self.pool._processes
+        self.flocks = []
+        self.live = frozenset()  # shared memory names of the open flocks
+
+    def share(self, flock, partitions=None):
+        """ move a Flock's state to shared memory, split in row partitions
+            stepped in parallel (by default one per process for big flocks) """
+        if partitions is None:
+            partitions = self.processes if len(flock) > b.DENSE_LIMIT else 1
+        shared = SharedFlock(self, flock, partitions)
+        self.flocks.append(shared)
+        self.live = self.live | {shared.shm.name}
+        return shared
+
+    def submit(self, function, *args):
+        return self.pool.apply_async(function, args)
+
+    def forget(self, flock):
+        """ closed flock: no longer stepped, its name left out of the live ones """
+        if flock in self.flocks:
+            self.flocks.remove(flock)
+        self.live = self.live - {flock.shm.name}
+
+    def close(self):
+        """ wait for running steps, stop the workers and free shared memory """
+        for flock in list(self.flocks):
+            flock.close()
+        self.flocks = []
+        self.pool.close()
+        self.pool.join()
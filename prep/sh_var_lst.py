@@ -2,8 +2,11 @@
 # list of all vs 'in' and uniforms of both vs n fs
 
 world_shader = {'vs': 'world.vert', 'fs': 'world.frag'}
+world_instanced_shader = {'vs': 'world_instanced.vert', 'fs': 'world.frag'}
 skybox_shader = {'vs': 'skybox.vert', 'fs': 'skybox.frag'}
 screen_shader = {'vs': 'screen.vert', 'fs': 'screen.frag'}
+depth_shader = {'vs': 'depth.vert', 'fs': 'depth.frag'}
+depth_instanced_shader = {'vs': 'depth_instanced.vert', 'fs': 'depth.frag'}
 
 screen_texture = 'screenTexture'
 exposure = 'exposure'
@@ -15,31 +18,28 @@ model = 'mvp.model'
 view = 'mvp.view'
 projection = 'mvp.projection'
 
-s = 'material.s'
 diffuse_map = 'material.diffuse_map'
 
 skybox = 'skybox'
 
-light_dir = 'dlamp.light_dir'
-d_k_a = 'dlamp.k_a'
-d_k_d = 'dlamp.k_d'
-d_k_s = 'dlamp.k_s'
-
-p = 'plamp'
-p_nb = 4
-p_pos = 'position'
-
-p_c = 'constant'
-p_l = 'linear'
-p_q = 'quadratic'
-
-p_k_a = 'k_a'
-p_k_d = 'k_d'
-p_k_s = 'k_s'
-
-
-def get_plamp_i(idx, var):
-    return str('{lamp}[{idx}].{var}').format(lamp=p, idx=idx, var=var)
-
-
-camera_position = 'camera.camera_position'
\ No newline at end of file
+# std140 uniform blocks, each with its binding point shared by all programs
+frame_block = 'FrameBlock'  # lights, camera and time, once per frame
+frame_binding = 0
+material_block = 'MaterialBlock'  # phong constants of the drawn material
+material_binding = 1
+
+# point lights, in world coords, any number: they are culled per cluster of
+# the view frustum and listed in texture buffers
+p_pos = [(0.7, 0.2, 2.0),
+         (2.3, -3.3, -4.0),
+         (-4.0, 2.0, -12.0),
+         (0.0, 0.0, -3.0)]
+p_color = (0.25, 0.25, 0.25)  # shared by the lamps
+p_attenuation = (1.0, 0.09, 0.032)  # constant, linear, quadratic
+
+# samplers of the light texture buffers, on the texture units after the
+# diffuse map's
+light_data = 'light_data'
+cluster_grid = 'cluster_grid'
+light_index = 'light_index'
+light_units = (1, 2, 3)
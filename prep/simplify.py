@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# mesh simplification by vertex clustering with quadric error placement
+
+import numpy as np
+
+LOD_RATIOS = (0.5, 0.25, 0.1)  # target triangle ratios of the coarser levels
+MAX_RESOLUTION = 256            # grid cells along the longest axis to start with
+RESOLUTION_STEP = 0.8           # grid refinement factor between attempts
+
+
+def face_quadrics(vertices, faces):
+    """ (F, 4, 4) area weighted plane quadric of each triangle """
+    corners = vertices[faces]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.linalg.norm(normals, axis=1)
+    normals = normals / np.maximum(areas, 1e-12)[:, np.newaxis]
+    planes = np.hstack([normals, -(normals * corners[:, 0]).sum(axis=1, keepdims=True)])
+    return planes[:, :, np.newaxis] * planes[:, np.newaxis, :] * (areas / 2)[:, np.newaxis, np.newaxis]
+
+
+def cluster(vertices, faces, resolution, quadrics=None):
+    """ Lindstrom style vertex clustering: vertices falling in the same cell
+        of a grid with 'resolution' cells along the longest axis merge into
+        the point minimizing the sum of the quadrics of their triangles.
+        Returns (cell of each vertex, representative of each cell) """
+    lower, upper = vertices.min(axis=0), vertices.max(axis=0)
+    size = max(float((upper - lower).max()), 1e-12) / resolution
+    cells = np.minimum(((vertices - lower) / size).astype(np.int64), resolution - 1)
+    _, cell_of = np.unique(cells[:, 0] + resolution * (cells[:, 1] + resolution * cells[:, 2]),
+                           return_inverse=True)
+    cell_of = cell_of.ravel()
+    nb_cells = cell_of.max() + 1
+
+    # cell quadric: sum of the quadrics of the triangles around its vertices
+    quadrics = face_quadrics(vertices, faces) if quadrics is None else quadrics
+    corner_cells = cell_of[faces].ravel()
+    cell_quadrics = np.stack([np.bincount(corner_cells, np.repeat(quadrics[:, i, j], 3), nb_cells)
+                              for i in range(4) for j in range(4)], axis=1).reshape(-1, 4, 4)
+
+    # representative: quadric minimum when well conditioned and in its cell,
+    # mean of the cell vertices otherwise
+    counts = np.bincount(cell_of, minlength=nb_cells)[:, np.newaxis]
+    means = np.stack([np.bincount(cell_of, vertices[:, i], nb_cells) for i in range(3)], axis=1) / counts
+    a, b = cell_quadrics[:, :3, :3], -cell_quadrics[:, :3, 3]
+    scale = np.abs(a).max(axis=(1, 2)) + 1e-30
+    solvable = np.abs(np.linalg.det(a / scale[:, np.newaxis, np.newaxis])) > 1e-6
+    points = means.copy()
+    if solvable.any():
+        points[solvable] = np.linalg.solve(a[solvable], b[solvable][:, :, np.newaxis])[:, :, 0]
+    cell_lower = np.floor((means - lower) / size) * size + lower
+    outside = ((points < cell_lower - size) | (points > cell_lower + 2 * size)).any(axis=1)
+    points[outside] = means[outside]
+    return cell_of, points
+
+
+def simplify(arrays, resolution, quadrics=None):
+    """ mesh arrays {'vertices', 'normals', 'tex_coords', 'faces'} clustered
+        on a grid of given resolution. Normals are averaged per cell, texture
+        coordinates taken from the cell vertex closest to its representative """
+    vertices = np.asarray(arrays['vertices'], np.float64)
+    faces = np.asarray(arrays['faces']).reshape(-1, 3)
+    cell_of, points = cluster(vertices, faces, resolution, quadrics)
+
+    # remap triangles, dropping the degenerate and duplicate ones
+    new_faces = cell_of[faces]
+    keep = ((new_faces[:, 0] != new_faces[:, 1]) & (new_faces[:, 1] != new_faces[:, 2])
+            & (new_faces[:, 0] != new_faces[:, 2]))
+    new_faces = new_faces[keep]
+    # rotate each triangle to start with its smallest index, keeping winding
+    first = new_faces.argmin(axis=1)[:, np.newaxis]
+    new_faces = np.take_along_axis(new_faces, (first + np.arange(3)) % 3, axis=1)
+    new_faces = np.unique(new_faces, axis=0)
+
+    # compact the cells still used by a triangle
+    used, new_faces = np.unique(new_faces, return_inverse=True)
+    new_faces = new_faces.reshape(-1, 3)
+
+    result = {'vertices': points[used].astype(np.float32), 'faces': new_faces.astype(np.uint32)}
+    if arrays.get('normals') is not None:
+        normals = np.asarray(arrays['normals'], np.float64)
+        sums = np.stack([np.bincount(cell_of, normals[:, i], len(points)) for i in range(normals.shape[1])], axis=1)
+        sums = sums[used]
+        result['normals'] = (sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)).astype(np.float32)
+    if arrays.get('tex_coords') is not None:
+        distances = np.linalg.norm(vertices - points[cell_of], axis=1)
+        order = np.lexsort((distances, cell_of))
+        firsts = order[np.r_[True, cell_of[order][1:] != cell_of[order][:-1]]]
+        nearest = np.empty(len(points), np.int64)
+        nearest[cell_of[firsts]] = firsts
+        result['tex_coords'] = np.asarray(arrays['tex_coords'], np.float32)[nearest[used]]
+    return result
+
+
+def lod_chain(arrays, ratios=LOD_RATIOS):
+    """ coarser versions of mesh arrays, one per triangle ratio. The grid is
+        refined until each level has at most its share of the triangles. A
+        level that can't be simplified further repeats the previous one """
+    faces = np.asarray(arrays['faces']).reshape(-1, 3)
+    vertices = np.asarray(arrays['vertices'], np.float64)
+    if not len(faces):
+        return [arrays for _ in ratios]
+    quadrics = face_quadrics(vertices, faces)
+    levels, previous, resolution = [], arrays, MAX_RESOLUTION
+    for ratio in ratios:
+        target = max(int(len(faces) * ratio), 1)
+        level = previous
+        while resolution >= 2:
+            candidate = simplify(arrays, resolution, quadrics)
+            if len(candidate['faces']) <= target:
+                level = candidate if len(candidate['faces']) else previous
+                break
+            resolution = int(resolution * RESOLUTION_STEP)
+        levels.append(level)
+        previous = level
+    return levels
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# on-disk cache of decoded texture mip chains, memory mapped when loaded
+#
+# file layout: MAGIC, uint32 header size, JSON header listing the levels,
+# then the raw RGBA8 rows of each level, finest first, each starting on an
+# ALIGN boundary at the offset recorded in the header
+
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+from PIL import Image
+
+import atomicfile
+
+MAGIC = b'TEXCACHE1\n'
+ALIGN = 16
+CACHE_DIR = os.path.join('.cache', 'textures')
+
+
+def cache_key(file):
+    """ hash of the source image contents """
+    digest = hashlib.sha1(MAGIC)
+    with open(file, 'rb') as content:
+        for chunk in iter(lambda: content.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def mip_chain(file):
+    """ RGBA8 arrays of the image in file, then of each box filtered half
+        size level down to 1x1 """
+    image = Image.open(file).convert('RGBA')
+    levels = [np.asarray(image)]
+    while image.width > 1 or image.height > 1:
+        image = image.resize((max(image.width // 2, 1), max(image.height // 2, 1)), Image.BOX)
+        levels.append(np.asarray(image))
+    return levels
+
+
+def write(path, levels):
+    """ store the (height, width, 4) uint8 levels atomically at path """
+    header, offset = {'levels': []}, 0
+    for level in levels:
+        header['levels'].append({'shape': level.shape, 'offset': offset})
+        offset += -(-level.nbytes // ALIGN) * ALIGN
+
+    # level offsets are relative to the data start, aligned after the header
+    blob = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 4 + len(blob)) // ALIGN) * ALIGN
+    with atomicfile.replace(path) as out:
+        out.write(MAGIC + struct.pack('<I', len(blob)) + blob)
+        for spec, level in zip(header['levels'], levels):
+            out.seek(data_start + spec['offset'])
+            out.write(np.ascontiguousarray(level, np.uint8).tobytes())
+        out.truncate(data_start + offset)
+
+
+def read(path):
+    """ levels stored by write(), memory mapped read only: the pages are
+        only read from disk when GL copies them to the texture """
+    with open(path, 'rb') as cache:
+        if cache.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a texture cache file: ' + path)
+        size, = struct.unpack('<I', cache.read(4))
+        header = json.loads(cache.read(size))
+    data_start = -(-(len(MAGIC) + 4 + size) // ALIGN) * ALIGN
+    return [np.memmap(path, np.uint8, 'r', data_start + spec['offset'], tuple(spec['shape']))
+            for spec in header['levels']]
+
+
+def load(file):
+    """ mip chain of image 'file' from the cache, or decoded and filtered
+        then cached. Safe in any thread, raises FileNotFoundError """
+    path = os.path.join(CACHE_DIR, cache_key(file) + '.tex')
+    if os.path.exists(path):
+        try:
+            return read(path)
+        except (ValueError, OSError, KeyError) as exception:
+            print('WARNING: ignoring broken texture cache', path, exception)
+    levels = mip_chain(file)
+    try:
+        write(path, levels)
+        return read(path)  # decoded pixels are freed, the mapping replaces them
+    except OSError as exception:
+        print('WARNING: unable to write texture cache', path, exception)
+    return levels
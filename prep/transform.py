@@ -13,6 +13,11 @@ import numpy as np          # matrices, vectors & quaternions are numpy arrays
 
 
 # Some useful functions on vectors -------------------------------------------
+def _output(out, shape):
+    """ 'out' array to write a result of given shape to, new if None """
+    return np.empty(shape, 'f') if out is None else out
+
+
 def vec(*iterable):
     """ shortcut to make numpy vector of any iterable(tuple...) or vector """
     return np.asarray(iterable if len(iterable) > 1 else iterable[0], 'f')
@@ -20,7 +25,7 @@ def vec(*iterable):
 
 def normalized(vector):
     """ normalized version of any vector, with zero division check """
-    norm = math.sqrt(sum(vector*vector))
+    norm = math.sqrt(np.dot(vector, vector))
     return vector / norm if norm > 0. else vector
 
 
@@ -45,16 +50,17 @@ def ortho(left, right, bot, top, near, far):
                      [0,    0,    0,     1]], 'f')
 
 
-def perspective(fovy, aspect, near, far):
-    """ perspective projection matrix, from field of view and aspect ratio """
+def perspective(fovy, aspect, near, far, out=None):
+    """ perspective projection matrix, from field of view and aspect ratio,
+        written to the 4x4 float32 'out' if given """
     _scale = 1.0/math.tan(math.radians(fovy)/2.0)
     sx, sy = _scale / aspect, _scale
     zz = (far + near) / (near - far)
     zw = 2 * far * near/(near - far)
-    return np.array([[sx, 0,  0,  0],
-                     [0,  sy, 0,  0],
-                     [0,  0, zz, zw],
-                     [0,  0, -1,  0]], 'f')
+    out = _output(out, (4, 4))
+    out[...] = 0
+    out[0, 0], out[1, 1], out[2, 2], out[2, 3], out[3, 2] = sx, sy, zz, zw, -1
+    return out
 
 
 def frustum(xmin, xmax, ymin, ymax, zmin, zmax):
@@ -82,7 +88,7 @@ def scale(x, y=None, z=None):
     """scale matrix, with uniform (x alone) or per-dimension (x,y,z) factors"""
     x, y, z = (x, y, z) if isinstance(x, Number) else (x[0], x[1], x[2])
     y, z = (x, x) if y is None or z is None else (y, z)  # uniform scaling
-    return np.diag((x, y, z, 1))
+    return np.diag(np.array((x, y, z, 1), 'f'))
 
 
 def sincos(degrees=0.0, radians=None):
@@ -102,16 +108,48 @@ def rotate(axis=(1., 0., 0.), angle=0.0, radians=None):
                      [0,            0,            0,            1]], 'f')
 
 
-def lookat(eye, target, up):
+def lookat(eye, target, up, out=None):
     """ Computes 4x4 view matrix from 3d point 'eye' to 'target',
-        'up' 3d vector fixes orientation """
-    view = normalized(vec(target)[:3] - vec(eye)[:3])
+        'up' 3d vector fixes orientation. Written to float32 'out' if given """
+    eye = vec(eye)[:3]
+    view = normalized(vec(target)[:3] - eye)
     up = normalized(vec(up)[:3])
     right = np.cross(view, up)
     up = np.cross(right, view)
-    rotation = np.identity(4)
-    rotation[:3, :3] = np.vstack([right, up, -view])
-    return rotation @ translate(-eye)
+    out = _output(out, (4, 4))
+    out[0, :3], out[1, :3], out[2, :3] = right, up, -view
+    out[:3, 3] = -out[:3, :3] @ eye
+    out[3] = (0, 0, 0, 1)
+    return out
+
+
+# View frustum culling -------------------------------------------------------
+def frustum_planes(matrix):
+    """ 6 normalized planes (a, b, c, d) of the frustum of a projection @ view
+        matrix: left, right, bottom, top, near, far. A point p is inside
+        when a*x + b*y + c*z + d >= 0 for all of them """
+    m = np.asarray(matrix, np.float64)
+    planes = np.array([m[3] + m[0], m[3] - m[0], m[3] + m[1],
+                       m[3] - m[1], m[3] + m[2], m[3] - m[2]])
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+
+def spheres_in_frustum(planes, centers, radii):
+    """ boolean mask of the (N, 3) centers, (N,) radii spheres intersecting
+        the frustum of frustum_planes(), tested all at once """
+    distances = np.asarray(centers).reshape(-1, 3) @ planes[:, :3].T + planes[:, 3]
+    return (distances >= -np.asarray(radii).reshape(-1, 1)).all(axis=1)
+
+
+def transform_spheres(matrices, center, radius):
+    """ (N, 3) centers and (N,) radii of model space bounding spheres under
+        each of the (N, 4, 4) matrices, the radius growing with their scale.
+        center and radius are one sphere for all, or one per matrix """
+    matrices = np.asarray(matrices).reshape(-1, 4, 4)
+    center = np.broadcast_to(np.asarray(center, matrices.dtype), (len(matrices), 3))
+    centers = np.einsum('nij,nj->ni', matrices[:, :3, :3], center) + matrices[:, :3, 3]
+    scales = np.sqrt((matrices[:, :3, :3] ** 2).sum(axis=1).max(axis=1))
+    return centers, radius * scales
 
 
 # quaternion functions -------------------------------------------------------
@@ -170,4 +208,120 @@ def quaternion_slerp(q0, q1, fraction):
     theta = theta_0 * fraction                # angle between q0 and result
     q2 = normalized(q1 - q0*dot)              # {q0, q2} now orthonormal basis
 
-    return q0*math.cos(theta) + q2*math.sin(theta)
\ No newline at end of file
+    return q0*math.cos(theta) + q2*math.sin(theta)
+
+# Batched versions, on (N, ...) arrays ----------------------------------------
+# Each builds all its N matrices or quaternions in one go, as float32, written
+# to the (N, 4, 4) or (N, 4) 'out' array if given instead of a new one.
+def normalized_many(vectors):
+    """ (N, D) vectors normalized along their last axis, zeros kept as is """
+    vectors = np.asarray(vectors, 'f')
+    norms = np.sqrt(np.einsum('...i,...i->...', vectors, vectors))[..., np.newaxis]
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def translate_many(vectors, out=None):
+    """ (N, 4, 4) translation matrices of the (N, 3) vectors """
+    vectors = np.asarray(vectors, 'f').reshape(-1, 3)
+    out = _output(out, (len(vectors), 4, 4))
+    out[...] = 0
+    out[:, range(4), range(4)] = 1
+    out[:, :3, 3] = vectors
+    return out
+
+
+def rotate_many(axes, angles=0.0, radians=None, out=None):
+    """ (N, 4, 4) rotation matrices around (N, 3) or one 'axes' by (N,) or
+        one 'angles' degrees or 'radians' """
+    angles = np.radians(angles) if radians is None else radians
+    axes = normalized_many(axes).reshape(-1, 3)
+    angles = np.asarray(angles, 'f').reshape(-1, 1)
+    axes, angles = np.broadcast_arrays(axes, angles)
+    angles = angles[:, 0]
+    s, c = np.sin(angles), np.cos(angles)
+    x, y, z = axes.T
+    nc = 1 - c
+    out = _output(out, (len(angles), 4, 4))
+    out[:, 0, 0], out[:, 0, 1], out[:, 0, 2] = x*x*nc + c,   x*y*nc - z*s, x*z*nc + y*s
+    out[:, 1, 0], out[:, 1, 1], out[:, 1, 2] = y*x*nc + z*s, y*y*nc + c,   y*z*nc - x*s
+    out[:, 2, 0], out[:, 2, 1], out[:, 2, 2] = x*z*nc - y*s, y*z*nc + x*s, z*z*nc + c
+    out[:, :3, 3] = 0
+    out[:, 3] = (0, 0, 0, 1)
+    return out
+
+
+def quaternion_matrix_many(quaternions, out=None):
+    """ (N, 4, 4) rotation matrices of the (N, 4) (w, x, y, z) quaternions """
+    q = normalized_many(np.asarray(quaternions, 'f').reshape(-1, 4))
+    w, x, y, z = q.T
+    out = _output(out, (len(q), 4, 4))
+    out[:, 0, 0], out[:, 0, 1], out[:, 0, 2] = 1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)
+    out[:, 1, 0], out[:, 1, 1], out[:, 1, 2] = 2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)
+    out[:, 2, 0], out[:, 2, 1], out[:, 2, 2] = 2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)
+    out[:, :3, 3] = 0
+    out[:, 3] = (0, 0, 0, 1)
+    return out
+
+
+def quaternion_slerp_many(q0, q1, fractions, out=None):
+    """ (N, 4) spherical interpolations of (N, 4) quaternions q0 and q1 by
+        the (N,) 'fractions', along the shorter path of each pair """
+    q0 = normalized_many(np.asarray(q0, 'f').reshape(-1, 4))
+    q1 = normalized_many(np.asarray(q1, 'f').reshape(-1, 4))
+    fractions = np.asarray(fractions, 'f').reshape(-1, 1)
+    dot = np.einsum('ni,ni->n', q0, q1)[:, np.newaxis]
+    q1 = np.where(dot < 0, -q1, q1)  # opposite handedness, see quaternion_slerp
+    dot = np.clip(np.abs(dot), 0, 1)
+
+    # almost equal quaternions: the sine vanishes, linear is as good
+    theta_0 = np.arccos(dot)
+    sin_0 = np.sin(theta_0)
+    close = sin_0 < 1e-4
+    sin_0 = np.where(close, 1, sin_0)
+    w0 = np.where(close, 1 - fractions, np.sin((1 - fractions) * theta_0) / sin_0)
+    w1 = np.where(close, fractions, np.sin(fractions * theta_0) / sin_0)
+    out = _output(out, q0.shape)
+    out[...] = normalized_many(w0 * q0 + w1 * q1)
+    return out
+
+
+def compose_trs_many(translations, quaternions, scales, out=None):
+    """ (N, 4, 4) matrices translate @ rotate @ scale from (N, 3)
+        translations, (N, 4) quaternions and scales: one uniform scale, one
+        (3,) per axis scale shared by all, (N,) or (N, 1) uniform scales or
+        (N, 3) per axis scales. A 1-D length 3 input is always per axis,
+        three uniform scales are given as (3, 1) """
+    out = quaternion_matrix_many(quaternions, out)
+    scales = np.asarray(scales, 'f')
+    if scales.ndim == 1 and len(scales) != 3:
+        scales = scales[:, np.newaxis]
+    out[:, :3, :3] *= np.broadcast_to(scales, (len(out), 3))[:, np.newaxis, :]  # scaled columns
+    out[:, :3, 3] = np.asarray(translations, 'f').reshape(-1, 3)
+    return out
+
+
+def quaternion_from_matrix_many(rotations):
+    """ (N, 4) unit quaternions of the (N, 3, 3) or (N, 4, 4) rotations """
+    m = np.asarray(rotations, np.float64)[..., :3, :3].reshape(-1, 3, 3)
+    m00, m11, m22 = m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]
+    sums = np.stack([1 + m00 + m11 + m22, 1 + m00 - m11 - m22, 1 - m00 + m11 - m22, 1 - m00 - m11 + m22], -1)
+    wx, wy, wz = m[:, 2, 1] - m[:, 1, 2], m[:, 0, 2] - m[:, 2, 0], m[:, 1, 0] - m[:, 0, 1]
+    xy, xz, yz = m[:, 0, 1] + m[:, 1, 0], m[:, 0, 2] + m[:, 2, 0], m[:, 1, 2] + m[:, 2, 1]
+    # 4 times the products of each component with the others, the largest
+    # component giving the most accurate row: the one whose 4 q^2 is the sum
+    products = np.stack([np.stack([sums[:, 0], wx, wy, wz], -1), np.stack([wx, sums[:, 1], xy, xz], -1),
+                         np.stack([wy, xy, sums[:, 2], yz], -1), np.stack([wz, xz, yz, sums[:, 3]], -1)], 1)
+    largest = sums.argmax(axis=1)
+    q = products[np.arange(len(m)), largest]
+    return normalized_many(q / np.sqrt(np.maximum(sums[np.arange(len(m)), largest], 1e-12))[:, np.newaxis])
+
+
+def decompose_trs_many(matrices):
+    """ (N, 3) translations, (N, 4) quaternions and (N, 3) per axis scales
+        of (N, 4, 4) translate @ rotate @ scale matrices, the inverse of
+        compose_trs_many. Shears are lost, mirrors flip the x scale """
+    m = np.asarray(matrices, 'f').reshape(-1, 4, 4)
+    scales = np.linalg.norm(m[:, :3, :3], axis=1)  # of the columns
+    scales[np.linalg.det(m[:, :3, :3]) < 0, 0] *= -1
+    rotations = m[:, :3, :3] / np.where(scales == 0, 1, scales)[:, np.newaxis, :]
+    return m[:, :3, 3].copy(), quaternion_from_matrix_many(rotations), scales
@@ -9,10 +9,23 @@ import nodes as n
 from itertools import cycle
 from model import Node
 from gpu import Shader
+from scheduler import FlockScheduler
 from camera import init_camera  # GLFWTrackball
+from clock import SimulationClock
+from scene import CompiledScene
+from pipeline import AssetPipeline
+from material import FrameUniforms, ClusteredLights
+from render import RenderPasses
+from occlusion import OcclusionCuller
+from glstate import gl
+from resources import resources
+import loaders as ld
+import meshopt
+import quantize
 
 SCR_WIDTH = 1280
 SCR_HEIGHT = 720
+Z_NEAR, Z_FAR = 0.1, 100.0
 
 
 class Viewer(Node):
@@ -45,8 +58,8 @@ class Viewer(Node):
         GL.glViewport(0, 0, width, height)
         # initialize GL by setting viewport and default render characteristics
         GL.glClearColor(0.1, 0.1, 0.1, 0.1)
-        GL.glEnable(GL.GL_DEPTH_TEST)  # depth test now enabled (TP2)
-        GL.glEnable(GL.GL_CULL_FACE)  # backface culling enabled (TP2)
+        gl.enable(GL.GL_DEPTH_TEST)  # depth test now enabled (TP2)
+        gl.enable(GL.GL_CULL_FACE)  # backface culling enabled (TP2)
 
         # initialize camera
         self.camera = init_camera(position=t.vec(0.0, 0.0, 3.0))
@@ -59,40 +72,120 @@ class Viewer(Node):
         self.delta_time = 0
         self.last_frame = 0
 
+        # constant root matrix, so that unchanged subtrees keep their cache
+        self.origin = t.identity()
+
+        # graph is drawn from its compiled array form, rebuilt when it changes
+        self.scene = None
+
+        # assets loading in the background, uploaded a few at each frame
+        self.pipeline = None
+
+        # meshes are queued during the traversal, then drawn pass by pass,
+        # the world pass optionally after a depth pre-pass of its packets
+        self.passes = RenderPasses(far=Z_FAR)
+        self.passes.depth_shaders = {False: Shader(svl.depth_shader['vs'], svl.depth_shader['fs']),
+                                     True: Shader(svl.depth_instanced_shader['vs'], svl.depth_instanced_shader['fs'])}
+        # occlusion nodes are skipped while hidden, found with box proxies
+        self.passes.occlusion = OcclusionCuller(self.passes.depth_shaders[False], near=Z_NEAR)
+
+        # lights, camera and time shared by all the meshes, set once a frame
+        self.frame_uniforms = FrameUniforms(Z_NEAR, Z_FAR)
+        self.lights = ClusteredLights(Z_NEAR, Z_FAR)
+
+        # animations and flocks are simulated at a fixed rate in a thread
+        self.clock = SimulationClock(self)
+
     def run(self):
         """ Main render loop for this OpenGL window """
+        self.clock.start()
+        try:
+            self._render_loop()
+        finally:
+            self.clock.stop()
+            resources.shutdown()  # GL objects go before the context
+
+    def _render_loop(self):
         while not glfw.window_should_close(self.win):
+            if self.pipeline is not None:
+                self.pipeline.drain()
+
+            # single timestamp for the whole frame, passed down the graph
+            frame_time, alpha = self.clock.frame()
             current_frame = glfw.get_time()
             self.delta_time = current_frame - self.last_frame
-            self.last_frame = current_frame - self.last_frame
+            self.last_frame = current_frame
             # clear draw buffer and depth buffer (<-TP2)
-            GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
-            GL.glEnable(GL.GL_DEPTH_TEST)
-            GL.glEnable(GL.GL_CULL_FACE)  # backface culling enabled (TP2)
-            GL.glDepthMask(GL.GL_TRUE)
+            gl.bind_framebuffer(0)
+            gl.enable(GL.GL_DEPTH_TEST)
+            gl.enable(GL.GL_CULL_FACE)  # backface culling enabled (TP2)
+            gl.depth_mask(GL.GL_TRUE)
 
             GL.glClearColor(0.1, 0.1, 0.1, 1.0)
             GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
 
             win_size = glfw.get_window_size(self.win)
             view = self.camera.get_view_matrix()
-            projection = t.perspective(self.camera.Zoom, win_size[0] / win_size[1], 0.1, 100.0)
+            projection = t.perspective(self.camera.Zoom, win_size[0] / win_size[1], Z_NEAR, Z_FAR)
 
             # draw our scene objects
-            self.draw(projection, view, t.identity())
+            self.frame_uniforms.update(self.camera.Position, frame_time, projection @ view)
+            self.lights.update(projection, view)
+            self.draw(projection, view, self.origin, time=frame_time, alpha=alpha, queue=self.passes)
+            self.passes.flush(projection, view, time=frame_time, alpha=alpha)
 
             # flush render commands, and swap draw buffers
             glfw.swap_buffers(self.win)
+            gl.end_frame()
+            resources.collect()  # deletions and evictions, context current
 
             # Poll for and process events
             glfw.poll_events()
 
+    def compile(self):
+        """ compiled scene of the current graph, rebuilt if its structure changed """
+        scene = self.scene
+        if scene is None or scene.stale:
+            if scene is not None:
+                scene.release()
+            scene = self.scene = CompiledScene(self)
+        return scene
+
+    def draw(self, projection, view, model, **param):
+        """ whole graph drawn from flat arrays, see scene.CompiledScene """
+        self.compile().draw(projection, view, model, **param)
+
+    def update(self, time, delta_time):
+        """ simulation step of the compiled nodes, called by the clock thread """
+        scene = self.scene
+        if scene is None:
+            super().update(time, delta_time)
+        else:
+            scene.update(time, delta_time)
+
     def on_key(self, _win, key, _scancode, action, _mods):
         """ 'Q' or 'Escape' quits """
         if action == glfw.PRESS or action == glfw.REPEAT:
             if key == glfw.KEY_ESCAPE or key == glfw.KEY_Q:
                 print("Au revoir, Don't hesitate to visit Atlantis again")
                 glfw.set_window_should_close(self.win, True)
+            if key == glfw.KEY_SPACE:
+                self.clock.reset()  # restart keyframe animations
+            if key == glfw.KEY_Z:
+                self.passes.prepass = not self.passes.prepass
+                print('Depth pre-pass', 'on' if self.passes.prepass else 'off')
+            if key == glfw.KEY_O:
+                self.passes.occlusion.enabled = not self.passes.occlusion.enabled
+                print('Occlusion culling', 'on' if self.passes.occlusion.enabled else 'off')
+            if key == glfw.KEY_I:
+                print('GL state calls last frame: %d issued, %d skipped' % gl.last_frame)
+                print('Draw packets last frame: %d drawn, %d culled' % self.passes.last_frame)
+                print('Occlusion last frame: %d queries, %d nodes and %d packets occluded'
+                      % self.passes.occlusion.last_frame)
+                print(quantize.memory_report())
+                print(meshopt.acmr_report())
+                print('Point lights last frame: %d in view, at most %d per cluster' % self.lights.last_frame)
+                print(resources.report())
 
             self.key_handler(key)
             # if key == glfw.KEY_LEFT_ALT:
@@ -160,6 +253,7 @@ def main():
     """ create a window, add scene objects, then run rendering loop """
     viewer = Viewer(SCR_WIDTH, SCR_HEIGHT)
     world_shader = Shader(svl.world_shader['vs'], svl.world_shader['fs'])
+    instanced_shader = Shader(svl.world_instanced_shader['vs'], svl.world_instanced_shader['fs'])
     skybox_shader = Shader(svl.skybox_shader['vs'], svl.skybox_shader['fs'])
     screen_shader = Shader(svl.screen_shader['vs'], svl.screen_shader['fs'])
 
@@ -167,15 +261,22 @@ def main():
 
     skybox_shape = n.get_skybox_node(skybox_shader)
 
+    # fish are loaded in the background and appear as soon as they are ready
+    viewer.pipeline = ld.pipeline = AssetPipeline()
     print('World Loading, Please Wait!!!')
-    world_shape = n.get_world_node(world_shader)
+    scheduler = FlockScheduler()  # flocks are simulated by worker processes
+    world_shape = n.get_world_node(world_shader, instanced_shader, scheduler)
 
-    # FOLLOW THIS ORDER STRICTLY IF YOU WANT EVERYTHING TO WORK
+    # drawn in render.PASSES order: screen, skybox then world
     viewer.add(screen_shape, skybox_shape, world_shape)
     # viewer.add(world_shape)
 
     print_msg()
-    viewer.run()
+    try:
+        viewer.run()
+    finally:
+        viewer.pipeline.close()
+        scheduler.close()
 
 
 if __name__ == '__main__':
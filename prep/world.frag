@@ -1,89 +1,87 @@
 #version 330 core
 
 in vec2 frag_tex_coords;
-in vec3 frag_position, frag_normal;
+in vec3 frag_pos, frag_normal;
 
 out vec4 out_color;
 
 struct Material{
     sampler2D diffuse_map;
-    float s;
 };
+uniform Material material;
 
-struct DirLight {
-    vec3 light_dir;
-
-    vec3 k_a;
-    vec3 k_d;
-    vec3 k_s;
+// shared by all meshes, updated once per frame
+layout(std140) uniform FrameBlock {
+    vec3 light_dir;                             // directional light
+    vec3 camera_position;
+    mat4 view_projection;
+    vec4 cluster_dims;                          // tiles x, y, depth slices
+    vec2 slice_scale_bias;                      // slice = log(depth) * x + y
+    float time;
 };
 
-struct PointLight {
-    vec3 position;
-
-    float constant;
-    float linear;
-    float quadratic;
-
+// phong constants of the material, lighting with all the lamps
+layout(std140) uniform MaterialBlock {
     vec3 k_a;
     vec3 k_d;
     vec3 k_s;
+    float s;
 };
 
-#define NB_POINT_LIGHTS 4
-
-struct Camera {
-    vec3 camera_position;
-};
-uniform Material material;
-uniform DirLight dlamp;
-uniform PointLight plamp[NB_POINT_LIGHTS];
-uniform Camera camera;
+// point lights culled per cluster, see lighting.py
+uniform samplerBuffer light_data;       // position & radius, color, attenuation & cutoff
+uniform usamplerBuffer cluster_grid;    // offset & count in light_index
+uniform usamplerBuffer light_index;     // lights of each cluster
 
-vec3 calc_dir_light(DirLight light, vec3 normal, vec3 camDir);
-vec3 calc_point_light(PointLight light, vec3 normal, vec3 fragPos, vec3 camDir);
+int cluster_of(vec3 position);
+vec3 calc_dir_light(vec3 normal, vec3 camDir);
+vec3 calc_point_light(int i, vec3 normal, vec3 fragPos, vec3 camDir);
 
 void main() {
     vec3 norm = normalize(frag_normal);
-    vec3 cam_dir = normalize(camera.camera_position - frag_position);
+    vec3 cam_dir = normalize(camera_position - frag_pos);
 
-    vec3 result = calc_dir_light(dlamp, norm, cam_dir);
-    for(int i = 0; i < NB_POINT_LIGHTS; i++){
-        result += calc_point_light(plamp[i], norm, frag_position, cam_dir) / 4;
+    vec3 result = calc_dir_light(norm, cam_dir);
+    uvec2 lights = texelFetch(cluster_grid, cluster_of(frag_pos)).xy;
+    for(uint i = lights.x; i < lights.x + lights.y; i++){
+        result += calc_point_light(int(texelFetch(light_index, int(i)).x), norm, frag_pos, cam_dir);
     }
-    out_color = vec4(result, 1);
+    // using diffuse map for specular as well
+    out_color = vec4(result * texture(material.diffuse_map, frag_tex_coords).rgb, 1);
 }
 
-vec3 calc_dir_light(DirLight lamp, vec3 normal, vec3 camDir){
-    vec3 ambient  = lamp.k_a  * texture(material.diffuse_map, frag_tex_coords).rgb;
+int cluster_of(vec3 position){
+    vec4 clip = view_projection * vec4(position, 1);
+    vec2 tile = clamp(floor((clip.xy / clip.w * 0.5 + 0.5) * cluster_dims.xy), vec2(0), cluster_dims.xy - 1);
+    float slice = clamp(floor(log(clip.w) * slice_scale_bias.x + slice_scale_bias.y), 0, cluster_dims.z - 1);
+    return int(tile.x + cluster_dims.x * (tile.y + cluster_dims.y * slice));
+}
 
-    vec3 lightDir = normalize(-lamp.light_dir);
+vec3 calc_dir_light(vec3 normal, vec3 camDir){
+    vec3 lightDir = normalize(-light_dir);
     float diff = max(dot(normal, lightDir), 0.0);
-    vec3 diffuse  = lamp.k_d  * diff * texture(material.diffuse_map, frag_tex_coords).rgb;
 
     vec3 reflectDir = reflect(-lightDir, normal);
-    float spec = pow(max(dot(camDir, reflectDir), 0.0), material.s);
-    vec3 specular = lamp.k_s * spec * texture(material.diffuse_map, frag_tex_coords).rgb; // using diffuse map for specular as well
+    float spec = pow(max(dot(camDir, reflectDir), 0.0), s);
 
-    return (ambient + diffuse + specular);
+    return k_a + k_d * diff + k_s * spec;
 }
 
-vec3 calc_point_light(PointLight lamp, vec3 normal, vec3 fragPos, vec3 camDir){
-    vec3 ambient  = lamp.k_a * texture(material.diffuse_map, frag_tex_coords).rgb;
+vec3 calc_point_light(int i, vec3 normal, vec3 fragPos, vec3 camDir){
+    vec4 position = texelFetch(light_data, 3 * i);
+    vec3 color = texelFetch(light_data, 3 * i + 1).rgb;
+    vec4 k = texelFetch(light_data, 3 * i + 2);
 
-    vec3 lightDir = normalize(lamp.position - fragPos);
+    vec3 lightDir = normalize(position.xyz - fragPos);
     float diff = max(dot(normal, lightDir), 0.0);
-    vec3 diffuse = lamp.k_d * (diff * texture(material.diffuse_map, frag_tex_coords).rgb);
 
     vec3 reflectDir = reflect(-lightDir, normal);
-    float spec = pow(max(dot(camDir, reflectDir), 0.0), material.s);
-    vec3 specular = lamp.k_s * (spec * texture(material.diffuse_map, frag_tex_coords).rgb);
+    float spec = pow(max(dot(camDir, reflectDir), 0.0), s);
 
-    float distance = length(lamp.position - fragPos);
-    float attenuation = 1.0 / (lamp.constant + (lamp.linear * distance) + (lamp.quadratic * (distance * distance)));
-    ambient  *= attenuation;
-    diffuse  *= attenuation;
-    specular *= attenuation;
+    // attenuation brought to 0 at the light radius, where it equals k.w
+    float distance = length(position.xyz - fragPos);
+    float attenuation = 1.0 / (k.x + (k.y * distance) + (k.z * (distance * distance)));
+    attenuation = max(attenuation - k.w, 0.0) / (1.0 - k.w);
 
-    return (ambient + diffuse + specular);
-}
\ No newline at end of file
+    return (k_a + k_d * diff + k_s * spec) * color * attenuation;
+}
@@ -14,6 +14,9 @@ struct MVP{
 };
 uniform MVP mvp;
 
+// same depth as the depth pre-pass, see depth.vert
+invariant gl_Position;
+
 void main() {
     gl_Position = mvp.projection * mvp.view * mvp.model * vec4(position, 1);
 
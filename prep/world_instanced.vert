@@ -0,0 +1,29 @@
+#version 330 core
+
+layout(location = 0) in vec3 position;
+layout(location = 1) in vec3 normal;
+layout(location = 2) in vec2 texCoord;
+layout(location = 3) in mat4 instance_model;  // one per fish, locations 3 to 6
+
+out vec3 frag_pos, frag_normal;
+out vec2 frag_tex_coords;
+
+struct MVP{
+    mat4 model;
+    mat4 view;
+    mat4 projection;
+};
+uniform MVP mvp;
+
+// same depth as the depth pre-pass, see depth.vert
+invariant gl_Position;
+
+void main() {
+    mat4 model = mvp.model * instance_model;
+    gl_Position = mvp.projection * mvp.view * model * vec4(position, 1);
+
+    frag_tex_coords = texCoord;
+
+    frag_pos = vec3(model * vec4(position, 1.0)); // fragment position
+    frag_normal = mat3(transpose(inverse(model))) * normal;
+}